@@ -0,0 +1,120 @@
+# Event-loop stall during a burst of play updates, before and after the async database layer (user-011).
+# Both sides run the helpers exactly as they were in main.py at that point: the shared module-level
+# cursor before, the Database read pool and writer task after. A 5 ms ticker records how late it wakes up.
+# Usage: python bench/bench_db_loop_stall.py [updates]
+import asyncio
+import functools
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from common import load_definitions, migration_names, request_commit
+
+USERS = 3000
+HISTORY_PER_USER = 50
+TICK = 0.005
+
+HELPERS = ['USER_FIELDS', 'UserRecord', 'load_user', 'get_user', 'save_user', 'update_user', 'CounterStore',
+           'get_audio_file_id', 'save_audio_file_id', 'log_history', 'configure_connection', 'run_migrations']
+LAYER = ['WriteResult', 'write_execute', 'write_executemany', 'read_fetchone', 'read_fetchall', 'Database',
+         'write_history']
+
+def load(revision, extra):
+    namespace = {
+        'asyncio': asyncio, 'functools': functools, 'sqlite3': sqlite3, 'time': time, 'datetime': datetime,
+        'OrderedDict': OrderedDict, 'namedtuple': namedtuple, 'ThreadPoolExecutor': ThreadPoolExecutor,
+        'DB_SYNCHRONOUS': 'NORMAL', 'DB_BUSY_TIMEOUT_MS': 5000, 'HISTORY_LIMIT': HISTORY_PER_USER
+    }
+    return load_definitions(migration_names(revision) + ['MIGRATIONS'] + HELPERS + extra, namespace, revision)
+
+def seed(path, namespace):
+    connection = sqlite3.connect(path)
+    namespace['configure_connection'](connection)
+    namespace['run_migrations'](connection)
+    connection.executemany("INSERT INTO users (id) VALUES (?)", ((uid,) for uid in range(USERS)))
+    connection.executemany(
+        "INSERT INTO history (user_id, title, artist, duration, video_id, created_at, source) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        ((uid, 't', 'a', '3:00', f"v{n}", f"2026-01-01T00:{n // 60:02d}:{n % 60:02d}", 'youtube')
+         for uid in range(USERS) for n in range(HISTORY_PER_USER))
+    )
+    connection.commit()
+    return connection
+
+def item(uid):
+    return {'video_id': f"p{uid}", 'title': 'Song', 'artist': 'Artist', 'duration': '3:00'}
+
+async def play_before(ns, uid):
+    user = ns['get_user'](uid)
+    ns['counter_store'].increment_action_count(uid)
+    ns['get_audio_file_id'](f"p{uid}")
+    await asyncio.sleep(0)  # the upload to Telegram
+    ns['save_audio_file_id'](f"p{uid}", 'file', 'unique')
+    ns['log_history'](uid, item(uid))
+    user.set(is_new_user=False)
+    ns['save_user'](user)
+
+async def play_after(ns, uid):
+    user = await ns['get_user'](uid)
+    try:
+        ns['counter_store'].increment_action_count(uid)
+        await ns['get_audio_file_id'](f"p{uid}")
+        await asyncio.sleep(0)  # the upload to Telegram
+        await ns['save_audio_file_id'](f"p{uid}", 'file', 'unique')
+        await ns['log_history'](uid, item(uid))
+        user.set(is_new_user=False)
+    finally:
+        ns['counter_store'].unpin(uid)
+        await ns['save_user'](user)
+
+async def ticker(lags, stop):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        started = loop.time()
+        await asyncio.sleep(TICK)
+        lags.append(loop.time() - started - TICK)
+
+async def measure(play, ns, updates):
+    lags = []
+    stop = asyncio.Event()
+    task = asyncio.create_task(ticker(lags, stop))
+    await asyncio.sleep(TICK * 2)
+    started = time.perf_counter()
+    await asyncio.gather(*(play(ns, n % USERS) for n in range(updates)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await task
+    lags.sort()
+    return elapsed, lags[-1] * 1000, lags[int(len(lags) * 0.99) - 1] * 1000
+
+async def run_before(path, updates):
+    ns = load(f"{request_commit('user-011')}^", [])
+    ns['conn'] = seed(path, ns)
+    ns['cursor'] = ns['conn'].cursor()
+    ns['counter_store'] = ns['CounterStore'](USERS * 2)
+    return await measure(play_before, ns, updates)
+
+async def run_after(path, updates):
+    ns = load(request_commit('user-011'), LAYER)
+    seed(path, ns).close()
+    ns['db'] = ns['Database'](path, 4, 200)
+    ns['counter_store'] = ns['CounterStore'](USERS * 2)
+    await ns['db'].start()
+    try:
+        return await measure(play_after, ns, updates)
+    finally:
+        await ns['db'].close()
+
+def main():
+    updates = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    with tempfile.TemporaryDirectory() as directory:
+        for label, run in (('shared cursor', run_before), ('async layer', run_after)):
+            elapsed, worst, p99 = asyncio.run(run(os.path.join(directory, f"{label[0]}.db"), updates))
+            print(f"{label:>13}: {updates} plays in {elapsed:.2f} s, loop stall max {worst:.0f} ms, p99 {p99:.0f} ms")
+
+if __name__ == '__main__':
+    main()
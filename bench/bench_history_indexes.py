@@ -0,0 +1,71 @@
+# Query latency on a database with 1M history rows, before and after migration_indexes.
+# Usage: python bench/bench_history_indexes.py [rows]
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+from common import load_definitions
+
+USERS = 20000
+QUERIES = 50
+
+defs = load_definitions([
+    'migration_base_schema', 'migration_total_downloads', 'migration_cache_tables', 'migration_broadcasts',
+    'migration_indexes', 'configure_connection'
+], {'DB_SYNCHRONOUS': 'NORMAL', 'DB_BUSY_TIMEOUT_MS': 5000})
+
+def build(path, rows, indexed):
+    connection = sqlite3.connect(path)
+    if indexed:
+        defs['configure_connection'](connection)
+    for name in ('migration_base_schema', 'migration_total_downloads', 'migration_cache_tables',
+                 'migration_broadcasts'):
+        defs[name](connection.cursor())
+    connection.executemany(
+        "INSERT INTO history (user_id, title, artist, duration, video_id, created_at, source) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        ((random.randrange(USERS), 't', 'a', '3:00', f"v{random.randrange(100000)}",
+          f"2026-0{random.randrange(1, 9)}-1{random.randrange(10)}T00:00:{random.randrange(60):02d}", 'youtube')
+         for _ in range(rows))
+    )
+    connection.executemany(
+        "INSERT INTO users (id, premium_until) VALUES (?, ?)",
+        ((i, '2027-01-01' if i % 50 == 0 else None) for i in range(200000))
+    )
+    connection.executemany(
+        "INSERT INTO payments (user_id, amount, days, status, created_at) VALUES (?, ?, ?, ?, ?)",
+        ((i, 199, 30, 'pending' if i % 100 == 0 else 'completed', '2026') for i in range(200000))
+    )
+    connection.commit()
+    if indexed:
+        defs['migration_indexes'](connection.cursor())
+        connection.commit()
+    return connection
+
+def timed(connection, sql, params):
+    started = time.perf_counter()
+    for _ in range(QUERIES):
+        connection.execute(sql, params() if callable(params) else params).fetchall()
+    return (time.perf_counter() - started) / QUERIES * 1000
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as directory:
+        for label, indexed in (('before', False), ('after', True)):
+            connection = build(os.path.join(directory, f"{label}.db"), rows, indexed)
+            history = timed(
+                connection,
+                "SELECT video_id, title, duration FROM history WHERE user_id = ? ORDER BY created_at DESC LIMIT 10",
+                lambda: (random.randrange(USERS),)
+            )
+            payments = timed(connection, "SELECT COUNT(*) FROM payments WHERE status = 'pending'", ())
+            premium = timed(connection, "SELECT COUNT(*) FROM users WHERE premium_until > ?", ('2026-10-18',))
+            connection.close()
+            print(f"{label:>6}: history {history:.3f} ms, pending payments {payments:.3f} ms, "
+                  f"premium users {premium:.3f} ms ({rows} history rows)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# Cost of recording one play in a history of 1M rows, before and after the per-user ring (user-012).
+# Before: the insert + DELETE trim that preceded the ring. After: write_history as it is now, run on
+# the same data after the current migrations renumber it. Each play is its own transaction.
+# Usage: python bench/bench_history_ring.py [plays]
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from common import load_definitions, migration_names, request_commit
+
+USERS = 20000
+HISTORY_LIMIT = 50
+
+def load(revision, extra=()):
+    namespace = {'datetime': datetime, 'time': time, 'DB_SYNCHRONOUS': 'NORMAL', 'DB_BUSY_TIMEOUT_MS': 5000,
+                 'HISTORY_LIMIT': HISTORY_LIMIT}
+    names = migration_names(revision) + ['MIGRATIONS', 'configure_connection', 'run_migrations', 'write_history']
+    return load_definitions(names + list(extra), namespace, revision)
+
+def seed(path, ns):
+    connection = sqlite3.connect(path, isolation_level=None)
+    ns['configure_connection'](connection)
+    ns['run_migrations'](connection)
+    connection.execute("BEGIN")
+    connection.executemany("INSERT INTO users (id) VALUES (?)", ((uid,) for uid in range(USERS)))
+    connection.executemany(
+        "INSERT INTO history VALUES (?, ?, ?, ?, ?, ?, ?)",
+        ((uid, 't', 'a', '3:00', f"v{n}", f"2026-01-01T00:{n // 60:02d}:{n % 60:02d}", 'youtube')
+         for uid in range(USERS) for n in range(HISTORY_LIMIT))
+    )
+    connection.execute("COMMIT")
+    return connection
+
+def measure(connection, play, plays):
+    random.seed(0)
+    cursor = connection.cursor()
+    started = time.perf_counter()
+    for n in range(plays):
+        item = {'video_id': f"p{n}", 'title': 'Song', 'artist': 'Artist', 'duration': '3:00'}
+        connection.execute("BEGIN")
+        play(cursor, random.randrange(USERS), item)
+        connection.execute("COMMIT")
+    return (time.perf_counter() - started) / plays * 1000
+
+def main():
+    plays = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    before = load(f"{request_commit('user-012')}^")
+    after = load(None, ['AUDIO_SOURCE_FORMAT'])
+    with tempfile.TemporaryDirectory() as directory:
+        connection = seed(os.path.join(directory, 'before.db'), before)
+        per_play = measure(connection, lambda cursor, uid, item: before['write_history'](cursor, uid, item, 'youtube'),
+                           plays)
+        connection.close()
+        print(f" insert + trim: {per_play:.3f} ms per play")
+
+        connection = seed(os.path.join(directory, 'after.db'), before)
+        started = time.perf_counter()
+        after['run_migrations'](connection)
+        migrated = time.perf_counter() - started
+        created_at = datetime.utcnow().isoformat()
+        per_play = measure(
+            connection, lambda cursor, uid, item: after['write_history'](cursor, uid, item, created_at, 'youtube'), plays
+        )
+        connection.close()
+        print(f"   ring upsert: {per_play:.3f} ms per play (migrating {USERS * HISTORY_LIMIT} rows took {migrated:.1f} s)")
+
+if __name__ == '__main__':
+    main()
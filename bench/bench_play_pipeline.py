@@ -0,0 +1,97 @@
+# Play throughput and latency with stubbed yt-dlp and Bot calls: the cb_play that preceded the upload
+# stage (download slot only, uploads unbounded) versus the current one (uploads go through upload_stage).
+# Upload models: "fixed" takes a constant time per file; "uplink" shares one link between all running uploads.
+# Usage: python bench/bench_play_pipeline.py [plays]
+import asyncio
+import statistics
+import sys
+import time
+from collections import OrderedDict, deque
+
+from common import load_definitions
+
+METADATA_WORKERS = 4
+DOWNLOAD_WORKERS = 3
+UPLOAD_WORKERS = 4
+RESOLVE_SECONDS = 0.3
+DOWNLOAD_SECONDS = 1.0
+UPLOAD_SECONDS = 0.8
+UPLINK_CHUNKS = 16
+
+defs = load_definitions(['StageBusyError', 'PipelineStage', 'DownloadJob', 'DownloadScheduler'], {
+    'asyncio': asyncio, 'time': time, 'OrderedDict': OrderedDict, 'deque': deque
+})
+
+class Stubs:
+    def __init__(self, upload_model):
+        self.upload_model = upload_model
+        self.metadata = asyncio.Semaphore(METADATA_WORKERS)
+        self.uplink = asyncio.Lock()
+        self.uploading = 0
+        self.peak_uploads = 0
+
+    async def track_get(self, video_id):
+        # track_store.get misses go through metadata_pool
+        async with self.metadata:
+            await asyncio.sleep(RESOLVE_SECONDS)
+        return {'video_id': video_id, 'title': 't', 'artist': 'a', 'duration': '3:00'}
+
+    async def prepare_audio(self, video_id):
+        await asyncio.sleep(DOWNLOAD_SECONDS)
+        return f"/tmp/{video_id}.m4a", 'm4a'
+
+    async def answer_audio(self, path, title=None, performer=None):
+        self.uploading += 1
+        self.peak_uploads = max(self.peak_uploads, self.uploading)
+        try:
+            if self.upload_model == 'fixed':
+                await asyncio.sleep(UPLOAD_SECONDS)
+            else:
+                for _ in range(UPLINK_CHUNKS):
+                    async with self.uplink:
+                        await asyncio.sleep(UPLOAD_SECONDS / UPLINK_CHUNKS)
+        finally:
+            self.uploading -= 1
+        return path
+
+async def play(stubs, scheduler, upload_stage, uid, video_id):
+    track = await stubs.track_get(video_id)
+    job = scheduler.submit(uid, False, lambda: stubs.prepare_audio(video_id))
+    await asyncio.wait({job.future})
+    audio_path, fmt = job.future.result()
+    if upload_stage is None:
+        return await stubs.answer_audio(audio_path, title=track['title'], performer=track['artist'])
+    return await upload_stage.run(stubs.answer_audio, audio_path, title=track['title'], performer=track['artist'])
+
+async def measure(plays, staged, upload_model):
+    stubs = Stubs(upload_model)
+    scheduler = defs['DownloadScheduler'](DOWNLOAD_WORKERS, plays)
+    upload_stage = defs['PipelineStage']('upload', UPLOAD_WORKERS, 50) if staged else None
+    if upload_stage:
+        upload_stage.start()
+    latencies = []
+
+    async def timed_play(n):
+        started = time.perf_counter()
+        await play(stubs, scheduler, upload_stage, n % 20, f"v{n}")
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(timed_play(n) for n in range(plays)))
+    elapsed = time.perf_counter() - started
+    if upload_stage:
+        upload_stage.stop()
+    return elapsed, statistics.mean(latencies), sorted(latencies)[int(len(latencies) * 0.95) - 1], stubs.peak_uploads
+
+def main():
+    plays = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    print(f"{plays} plays: resolve {RESOLVE_SECONDS}s ({METADATA_WORKERS} metadata workers), download "
+          f"{DOWNLOAD_SECONDS}s ({DOWNLOAD_WORKERS} workers), upload {UPLOAD_SECONDS}s")
+    for upload_model in ('fixed', 'uplink'):
+        for label, staged in (('previous', False), ('upload_stage', True)):
+            elapsed, mean, p95, peak = asyncio.run(measure(plays, staged, upload_model))
+            print(f"{upload_model:>6} {label:>12}: {elapsed:.1f} s, {plays / elapsed:.2f} plays/s, "
+                  f"latency mean {mean:.1f} s / p95 {p95:.1f} s, peak concurrent uploads {peak}")
+
+if __name__ == '__main__':
+    main()
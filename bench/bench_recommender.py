@@ -0,0 +1,139 @@
+# Recommender cost and correctness (user-017), with the scipy matrix and with the pure-Python fallback.
+# Timing: rebuild from a synthetic history of 20000 users x 30 tracks in 20 genres, then recommend() for
+# sampled users after a burst of incremental plays. Consistency: random plays go through write_history into a
+# 3-slot ring, with the recommender following adds and evictions; its baskets, scores and ranked scores
+# must equal a rebuild from the resulting table.
+# Usage: python bench/bench_recommender.py [users]
+import asyncio
+import random
+import sqlite3
+import statistics
+import sys
+import time
+from datetime import datetime
+
+from common import load_definitions, migration_names
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = None
+    sparse = None
+
+TRACKS_PER_USER = 30
+GENRES = 20
+TRACKS_PER_GENRE = 200
+INCREMENTAL_PLAYS = 3000
+SAMPLED_USERS = 1000
+RING_SLOTS = 3
+RING_USERS = 20
+RING_TRACKS = 15
+RING_PLAYS = 400
+
+class Rows:
+    # Stands in for db in Recommender.rebuild
+    def __init__(self, rows):
+        self.rows = rows
+
+    async def fetchall(self, query, params=()):
+        return self.rows
+
+def load(matrix, extra=(), namespace=None):
+    namespace = dict(namespace or {})
+    namespace.update({'asyncio': asyncio, 'np': np if matrix else None, 'sparse': sparse if matrix else None})
+    return load_definitions(['build_cooccurrence', 'grow_matrix', 'Recommender', *extra], namespace)
+
+def synthetic_rows(users):
+    random.seed(1)
+    rows = set()
+    for uid in range(users):
+        genre = uid % GENRES
+        for _ in range(TRACKS_PER_USER):
+            rows.add((uid, f"g{genre}_{random.randrange(TRACKS_PER_GENRE)}"))
+    return list(rows)
+
+async def timing(matrix, users):
+    ns = load(matrix)
+    ns['db'] = Rows(synthetic_rows(users))
+    recommender = ns['Recommender'](50000, 200)
+    started = time.perf_counter()
+    await recommender.rebuild()
+    rebuild = time.perf_counter() - started
+    random.seed(2)
+    for _ in range(INCREMENTAL_PLAYS):
+        uid = random.randrange(users)
+        recommender.add(uid, f"g{uid % GENRES}_{random.randrange(TRACKS_PER_GENRE)}")
+    latencies = []
+    same_genre = 0
+    for uid in random.sample(range(users), SAMPLED_USERS):
+        started = time.perf_counter()
+        recommended = recommender.recommend(uid, 20)
+        latencies.append(time.perf_counter() - started)
+        same_genre += all(video_id.startswith(f"g{uid % GENRES}_") for video_id in recommended)
+    latencies.sort()
+    return (rebuild, statistics.mean(latencies) * 1000, latencies[int(len(latencies) * 0.95) - 1] * 1000,
+            same_genre)
+
+def scored(recommender, uid):
+    basket = recommender.baskets.get(uid)
+    if not basket:
+        return {}
+    return {recommender.items[column]: round(score / recommender.popularity[column] ** 0.5, 4)
+            for column, score in recommender.scores(basket) if score > 0 and column not in basket}
+
+def consistency(matrix):
+    names = migration_names() + ['MIGRATIONS', 'configure_connection', 'run_migrations', 'write_history',
+                                 'AUDIO_SOURCE_FORMAT']
+    ns = load(matrix, names, {'datetime': datetime, 'time': time, 'DB_SYNCHRONOUS': 'NORMAL',
+                              'DB_BUSY_TIMEOUT_MS': 5000, 'HISTORY_LIMIT': RING_SLOTS})
+    connection = sqlite3.connect(':memory:', isolation_level=None)
+    ns['configure_connection'](connection)
+    ns['run_migrations'](connection)
+    cursor = connection.cursor()
+    # Small compaction threshold so the scipy side also folds increments into the matrix along the way
+    incremental = ns['Recommender'](50, 200)
+    incremental.ready = True
+    random.seed(3)
+    for _ in range(RING_PLAYS):
+        uid = random.randrange(RING_USERS)
+        video_id = f"v{random.randrange(RING_TRACKS)}"
+        item = {'video_id': video_id, 'title': 't', 'artist': 'a', 'duration': '3:00'}
+        evicted = ns['write_history'](cursor, uid, item, datetime.utcnow().isoformat(), 'youtube')
+        incremental.add(uid, video_id)
+        if evicted:
+            incremental.remove(uid, evicted)
+    ns['db'] = Rows(cursor.execute("SELECT user_id, video_id FROM history").fetchall())
+    rebuilt = ns['Recommender'](50, 200)
+    asyncio.run(rebuilt.rebuild())
+
+    def baskets(recommender):
+        return {uid: {recommender.items[column] for column in basket}
+                for uid, basket in recommender.baskets.items() if basket}
+
+    def ranked(recommender, uid):
+        # Equal scores are ordered by column number, which differs between the two, so compare the score ladder
+        scores = scored(recommender, uid)
+        return [scores[video_id] for video_id in recommender.recommend(uid, 10)]
+
+    return (baskets(incremental) == baskets(rebuilt),
+            all(scored(incremental, uid) == scored(rebuilt, uid) for uid in range(RING_USERS)),
+            all(ranked(incremental, uid) == ranked(rebuilt, uid) for uid in range(RING_USERS)))
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    modes = [('pure Python', False)] + ([('scipy', True)] if sparse is not None else [])
+    print(f"{users} users x {TRACKS_PER_USER} tracks, {INCREMENTAL_PLAYS} incremental plays, "
+          f"{SAMPLED_USERS} sampled users")
+    for label, matrix in modes:
+        rebuild, mean, p95, same_genre = asyncio.run(timing(matrix, users))
+        print(f"{label:>11}: rebuild {rebuild:.2f} s, recommend mean {mean:.2f} ms / p95 {p95:.2f} ms, "
+              f"{same_genre}/{SAMPLED_USERS} lists entirely in the user's genre")
+    for label, matrix in modes:
+        same_baskets, same_scores, same_ranking = consistency(matrix)
+        print(f"{label:>11}: {RING_PLAYS} plays into a {RING_SLOTS}-slot ring, incremental vs rebuild: baskets "
+              f"{'match' if same_baskets else 'DIFFER'}, scores {'match' if same_scores else 'DIFFER'}, "
+              f"ranked scores {'match' if same_ranking else 'DIFFER'}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+# Memory held by 100k active search sessions: result dicts in FSM state versus ResultStore.
+# Each variant runs in its own process and reports its peak RSS growth.
+# Usage: python bench/bench_result_store.py [sessions]
+import random
+import resource
+import secrets
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+from common import load_definitions
+
+RESULTS_PER_SESSION = 20
+DISTINCT_TRACKS = 50000
+
+def fresh_results():
+    # yt-dlp hands back new string objects for every search, even for tracks seen before
+    results = []
+    for _ in range(RESULTS_PER_SESSION):
+        n = random.randrange(DISTINCT_TRACKS)
+        results.append({
+            'video_id': ''.join(['vid', str(n).zfill(8)]),
+            'title': ''.join(['Song title number ', str(n), ' (Official Audio)']),
+            'artist': ''.join(['Artist ', str(n % 500)]),
+            'duration': ''.join([str(n % 10), ':', str(n % 60).zfill(2)])
+        })
+    return results
+
+def peak_rss_kib():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_variant(variant, sessions):
+    random.seed(0)
+    before = peak_rss_kib()
+    if variant == 'fsm':
+        states = [{'search_results': fresh_results()} for _ in range(sessions)]
+    else:
+        defs = load_definitions(['ResultStore'], {'OrderedDict': OrderedDict, 'secrets': secrets, 'sys': sys,
+                                                  'time': time})
+        store = defs['ResultStore'](sessions * 2, 3600)
+        for _ in range(sessions):
+            store.put(fresh_results())
+    print((peak_rss_kib() - before) / 1024)
+
+def main():
+    if len(sys.argv) > 2:
+        run_variant(sys.argv[1], int(sys.argv[2]))
+        return
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for variant, label in (('fsm', 'FSM state dicts'), ('store', 'ResultStore')):
+        output = subprocess.run([sys.executable, __file__, variant, str(sessions)],
+                                capture_output=True, text=True, check=True).stdout
+        print(f"{label:>16}: {float(output):.0f} MiB for {sessions} sessions x {RESULTS_PER_SESSION} results")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+# Helpers for the benchmarks in this directory. Importing main.py needs a bot token and
+# creates files, so the benchmarks pull the definitions they exercise straight from its source.
+import ast
+import logging
+import os
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN_PATH = os.path.join(ROOT, 'main.py')
+
+def request_commit(request_id):
+    # The first commit tagged with the request id is the change itself; later ones are review fixes
+    commits = subprocess.run(
+        ['git', 'log', '--reverse', '--format=%H', f"--grep=^\\[{request_id}\\]"],
+        cwd=ROOT, capture_output=True, text=True, check=True
+    ).stdout.split()
+    if not commits:
+        raise LookupError(f"No commit for {request_id}")
+    return commits[0]
+
+def read_source(revision=None):
+    if revision is None:
+        with open(MAIN_PATH, encoding='utf-8') as source:
+            return source.read()
+    return subprocess.run(
+        ['git', 'show', f"{revision}:main.py"], cwd=ROOT, capture_output=True, text=True, check=True
+    ).stdout
+
+def load_definitions(names, namespace=None, revision=None):
+    namespace = {} if namespace is None else namespace
+    namespace.setdefault('logger', logging.getLogger('bench'))
+    tree = ast.parse(read_source(revision))
+    wanted = set(names)
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            name = node.name
+        elif isinstance(node, ast.Assign) and isinstance(node.targets[0], ast.Name):
+            name = node.targets[0].id
+        else:
+            continue
+        if name in wanted:
+            exec(compile(ast.Module([node], []), revision or MAIN_PATH, 'exec'), namespace)
+            wanted.discard(name)
+    if wanted:
+        raise LookupError(f"Not found in main.py: {', '.join(sorted(wanted))}")
+    return namespace
+
+def migration_names(revision=None):
+    # The migration functions listed in MIGRATIONS at that revision, so a benchmark can build its schema
+    for node in ast.parse(read_source(revision)).body:
+        if isinstance(node, ast.Assign) and getattr(node.targets[0], 'id', None) == 'MIGRATIONS':
+            return [element.id for element in node.value.elts]
+    raise LookupError("MIGRATIONS not found")
@@ -3,19 +3,41 @@ import re
 import asyncio
 import logging
 import random
+import secrets
+import shutil
+import subprocess
+import socket
 import sqlite3
+import time
+import functools
+import hashlib
+import json
+import sys
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import Bot, Dispatcher, BaseMiddleware, types, F
 from aiogram.filters import Command
 from aiogram.client.default import DefaultBotProperties
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.types import InlineKeyboardButton, FSInputFile
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 import yt_dlp
 from cryptography.fernet import Fernet
 from dotenv import load_dotenv
 
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = None
+    sparse = None
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -63,8 +85,17 @@ except FileNotFoundError:
 
 API_TOKEN = decrypt_token(ENCRYPTED_TOKEN, ENCRYPTION_KEY)
 
+# Empty WEBHOOK_URL keeps long polling
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '').rstrip('/')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+# Same default in every process so replicas don't overwrite each other's secret
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or hashlib.sha256(API_TOKEN.encode()).hexdigest()[:32]
+WEBAPP_HOST = os.getenv('WEBAPP_HOST', '0.0.0.0')
+WEBAPP_PORT = int(os.getenv('WEBAPP_PORT', '8080'))
+
 MAX_FILE_SIZE = 50 * 1024 * 1024
 MAX_RESULTS = 20
+HISTORY_LIMIT = 50
 AD_ACTION_THRESHOLD = 20
 PREMIUM_DAYS = {"30": 30, "90": 90, "365": 365}
 PREMIUM_PRICES = {"30": 199, "90": 499, "365": 2299}
@@ -73,84 +104,583 @@ ADMIN_IDS = [int(id) for id in os.getenv('ADMIN_IDS', '7026603143').split(',')]
 CHANNEL_ID = int(os.getenv('CHANNEL_ID', '-1002715409948'))
 CHANNEL_USERNAME = os.getenv('CHANNEL_USERNAME', '@SoundPlus1')
 PAYMENT_CHANNEL_ID = int(os.getenv('PAYMENT_CHANNEL_ID', '-1002747322675'))
+SEARCH_WORKERS = int(os.getenv('SEARCH_WORKERS', '4'))
+SEARCH_QUEUE_TIMEOUT = float(os.getenv('SEARCH_QUEUE_TIMEOUT', '15'))
+METADATA_WORKERS = int(os.getenv('METADATA_WORKERS', '4'))
+METADATA_QUEUE_TIMEOUT = float(os.getenv('METADATA_QUEUE_TIMEOUT', '10'))
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', '3'))
+DOWNLOAD_QUEUE_TIMEOUT = float(os.getenv('DOWNLOAD_QUEUE_TIMEOUT', '60'))
+TRACK_CACHE_SIZE = int(os.getenv('TRACK_CACHE_SIZE', '10000'))
+TRACK_CACHE_TTL = int(os.getenv('TRACK_CACHE_TTL', str(7 * 24 * 3600)))
+SEARCH_CACHE_SIZE = int(os.getenv('SEARCH_CACHE_SIZE', '5000'))
+SEARCH_CACHE_TTL = int(os.getenv('SEARCH_CACHE_TTL', '3600'))
+SEARCH_CACHE_STALE_TTL = int(os.getenv('SEARCH_CACHE_STALE_TTL', str(24 * 3600)))
+AUDIO_CACHE_DIR = os.getenv('AUDIO_CACHE_DIR', 'cache/audio')
+AUDIO_CACHE_MAX_BYTES = int(os.getenv('AUDIO_CACHE_MAX_BYTES', str(2 * 1024 ** 3)))
+AUDIO_STAGING_MAX_AGE = int(os.getenv('AUDIO_STAGING_MAX_AGE', '3600'))
+AUDIO_CACHE_MIN_IDLE = int(os.getenv('AUDIO_CACHE_MIN_IDLE', '600'))
+AUDIO_SOURCE_FORMAT = 'bestaudio'
+TRANSCODE_ENABLED = os.getenv('TRANSCODE_ENABLED', '0') == '1'
+FFMPEG_BINARY = os.getenv('FFMPEG_BINARY', 'ffmpeg')
+TRANSCODE_CODEC = os.getenv('TRANSCODE_CODEC', 'mp3')
+TRANSCODE_FREE_BITRATE = int(os.getenv('TRANSCODE_FREE_BITRATE', '96'))
+TRANSCODE_PREMIUM_BITRATE = int(os.getenv('TRANSCODE_PREMIUM_BITRATE', '192'))
+TRANSCODE_WORKERS = int(os.getenv('TRANSCODE_WORKERS', '2'))
+TRANSCODE_QUEUE_TIMEOUT = float(os.getenv('TRANSCODE_QUEUE_TIMEOUT', '60'))
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', '4'))
+UPLOAD_QUEUE_SIZE = int(os.getenv('UPLOAD_QUEUE_SIZE', '50'))
+DOWNLOAD_MAX_QUEUE = int(os.getenv('DOWNLOAD_MAX_QUEUE', '100'))
+DOWNLOAD_STATUS_INTERVAL = float(os.getenv('DOWNLOAD_STATUS_INTERVAL', '2'))
+PREFETCH_CONCURRENCY = int(os.getenv('PREFETCH_CONCURRENCY', '1'))
+PREFETCH_BUDGET_BYTES = int(os.getenv('PREFETCH_BUDGET_BYTES', str(1024 ** 3)))
+PREFETCH_BUDGET_WINDOW = int(os.getenv('PREFETCH_BUDGET_WINDOW', '3600'))
+PREFETCH_MAX_AGE = float(os.getenv('PREFETCH_MAX_AGE', '30'))
+PREFETCH_QUEUE_SIZE = int(os.getenv('PREFETCH_QUEUE_SIZE', '50'))
+PREFETCH_TOP_RESULTS = int(os.getenv('PREFETCH_TOP_RESULTS', '1'))
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '10'))
+BROADCAST_BATCH_SIZE = int(os.getenv('BROADCAST_BATCH_SIZE', '200'))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv('BROADCAST_PROGRESS_INTERVAL', '5'))
+BROADCAST_MAX_RETRIES = 3
+BROADCAST_LEASE_SECONDS = float(os.getenv('BROADCAST_LEASE_SECONDS', '120'))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+COUNTER_FLUSH_INTERVAL = float(os.getenv('COUNTER_FLUSH_INTERVAL', '10'))
+COUNTER_CACHE_SIZE = int(os.getenv('COUNTER_CACHE_SIZE', '50000'))
+DB_PATH = os.getenv('DB_PATH', 'music_bot_youtube.db')
+DB_SYNCHRONOUS = os.getenv('DB_SYNCHRONOUS', 'NORMAL')
+DB_BUSY_TIMEOUT_MS = int(os.getenv('DB_BUSY_TIMEOUT_MS', '5000'))
+DB_READERS = int(os.getenv('DB_READERS', '4'))
+DB_WRITE_BATCH_SIZE = int(os.getenv('DB_WRITE_BATCH_SIZE', '200'))
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', '0.5'))
+LOOP_LAG_WARNING = float(os.getenv('LOOP_LAG_WARNING', '0.1'))
+BOT_STATUS_POLL_INTERVAL = float(os.getenv('BOT_STATUS_POLL_INTERVAL', '2'))
+SUBSCRIPTION_POSITIVE_TTL = int(os.getenv('SUBSCRIPTION_POSITIVE_TTL', '1800'))
+SUBSCRIPTION_NEGATIVE_TTL = int(os.getenv('SUBSCRIPTION_NEGATIVE_TTL', '30'))
+FAN_OUT_CONCURRENCY = int(os.getenv('FAN_OUT_CONCURRENCY', '5'))
+FAN_OUT_PER_QUERY = int(os.getenv('FAN_OUT_PER_QUERY', '6'))
+FAN_OUT_DEADLINE = float(os.getenv('FAN_OUT_DEADLINE', '8'))
+RECOMMENDER_COMPACT_THRESHOLD = int(os.getenv('RECOMMENDER_COMPACT_THRESHOLD', '50000'))
+RECOMMENDER_CANDIDATES = int(os.getenv('RECOMMENDER_CANDIDATES', '200'))
+RECOMMENDER_REBUILD_INTERVAL = int(os.getenv('RECOMMENDER_REBUILD_INTERVAL', '900'))
+RESULT_STORE_SIZE = int(os.getenv('RESULT_STORE_SIZE', '200000'))
+RESULT_STORE_TTL = int(os.getenv('RESULT_STORE_TTL', '3600'))
+CHART_REFRESH_INTERVAL = int(os.getenv('CHART_REFRESH_INTERVAL', '3600'))
+CHART_PREWARM_COUNT = int(os.getenv('CHART_PREWARM_COUNT', '5'))
+FSM_TTL = int(os.getenv('FSM_TTL', str(24 * 3600)))
+FSM_PURGE_INTERVAL = float(os.getenv('FSM_PURGE_INTERVAL', '600'))
 
 bot = Bot(token=API_TOKEN, default=DefaultBotProperties(parse_mode='HTML'))
-dp = Dispatcher()
-
-conn = sqlite3.connect('music_bot_youtube.db')
-cursor = conn.cursor()
-
-cursor.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY,
-        balance INTEGER DEFAULT 0,
-        referrals INTEGER DEFAULT 0,
-        lang TEXT DEFAULT 'Русский',
-        premium_until TEXT,
-        downloads_today INTEGER DEFAULT 0,
-        total_downloads INTEGER DEFAULT 0,
-        last_reset TEXT DEFAULT '',
-        action_count INTEGER DEFAULT 0,
-        is_new_user BOOLEAN DEFAULT TRUE,
-        referrer_id INTEGER DEFAULT NULL
-    )
-""")
 
-# Migrate existing database to add total_downloads column
-try:
-    cursor.execute("ALTER TABLE users ADD COLUMN total_downloads INTEGER DEFAULT 0")
-    conn.commit()
-    logger.info("Added total_downloads column to users table")
-except sqlite3.OperationalError:
-    logger.info("total_downloads column already exists")
-
-cursor.execute("""
-    CREATE TABLE IF NOT EXISTS payments (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        amount INTEGER,
-        days INTEGER,
-        screenshot TEXT,
-        status TEXT DEFAULT 'pending',
-        created_at TEXT,
-        processed_at TEXT
-    )
-""")
-
-cursor.execute("""
-    CREATE TABLE IF NOT EXISTS history (
-        user_id INTEGER,
-        title TEXT,
-        artist TEXT,
-        duration TEXT,
-        video_id TEXT,
-        created_at TEXT,
-        source TEXT
-    )
-""")
-
-cursor.execute("""
-    CREATE TABLE IF NOT EXISTS favorites (
-        user_id INTEGER,
-        title TEXT,
-        artist TEXT,
-        duration TEXT,
-        video_id TEXT,
-        created_at TEXT,
-        source TEXT
+def migration_base_schema(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            balance INTEGER DEFAULT 0,
+            referrals INTEGER DEFAULT 0,
+            lang TEXT DEFAULT 'Русский',
+            premium_until TEXT,
+            downloads_today INTEGER DEFAULT 0,
+            total_downloads INTEGER DEFAULT 0,
+            last_reset TEXT DEFAULT '',
+            action_count INTEGER DEFAULT 0,
+            is_new_user BOOLEAN DEFAULT TRUE,
+            referrer_id INTEGER DEFAULT NULL
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS payments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            amount INTEGER,
+            days INTEGER,
+            screenshot TEXT,
+            status TEXT DEFAULT 'pending',
+            created_at TEXT,
+            processed_at TEXT
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS history (
+            user_id INTEGER,
+            title TEXT,
+            artist TEXT,
+            duration TEXT,
+            video_id TEXT,
+            created_at TEXT,
+            source TEXT
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS favorites (
+            user_id INTEGER,
+            title TEXT,
+            artist TEXT,
+            duration TEXT,
+            video_id TEXT,
+            created_at TEXT,
+            source TEXT
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS bot_status (
+            id INTEGER PRIMARY KEY,
+            is_disabled BOOLEAN DEFAULT FALSE,
+            disabled_until TEXT
+        )
+    """)
+    cursor.execute("INSERT OR IGNORE INTO bot_status (id, is_disabled) VALUES (1, FALSE)")
+
+def migration_total_downloads(cursor):
+    # Databases created before total_downloads existed
+    cursor.execute("PRAGMA table_info(users)")
+    if 'total_downloads' not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE users ADD COLUMN total_downloads INTEGER DEFAULT 0")
+
+def migration_cache_tables(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS tracks (
+            video_id TEXT PRIMARY KEY,
+            title TEXT,
+            artist TEXT,
+            duration TEXT,
+            updated_at REAL
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS audio_files (
+            video_id TEXT PRIMARY KEY,
+            file_id TEXT,
+            file_unique_id TEXT,
+            created_at TEXT
+        )
+    """)
+
+def migration_broadcasts(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER,
+            text TEXT,
+            photo_path TEXT,
+            video_path TEXT,
+            media_file_id TEXT,
+            button_title TEXT,
+            button_url TEXT,
+            status TEXT DEFAULT 'running',
+            last_user_id INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            progress_message_id INTEGER,
+            created_at TEXT,
+            finished_at TEXT
+        )
+    """)
+
+def migration_indexes(cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_history_user_created ON history (user_id, created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_favorites_user_created ON favorites (user_id, created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_payments_status_created ON payments (status, created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_premium_until ON users (premium_until)")
+
+def migration_unique_favorites(cursor):
+    cursor.execute("""
+        DELETE FROM favorites WHERE rowid NOT IN
+        (SELECT MIN(rowid) FROM favorites GROUP BY user_id, video_id)
+    """)
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_favorites_user_video ON favorites (user_id, video_id)")
+
+def migration_history_ring(cursor):
+    # history becomes a per-user ring: seq grows forever, slot = seq % HISTORY_LIMIT is overwritten in place
+    cursor.execute("ALTER TABLE history ADD COLUMN seq INTEGER")
+    cursor.execute("ALTER TABLE history ADD COLUMN slot INTEGER")
+    cursor.execute(f"""
+        DELETE FROM history WHERE rowid IN (
+            SELECT rid FROM (
+                SELECT rowid AS rid, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY created_at DESC) AS rn
+                FROM history
+            ) WHERE rn > {HISTORY_LIMIT}
+        )
+    """)
+    cursor.execute("CREATE TEMP TABLE history_seq (rid INTEGER PRIMARY KEY, seq INTEGER)")
+    cursor.execute("""
+        INSERT INTO history_seq
+        SELECT rowid, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY created_at) - 1 FROM history
+    """)
+    cursor.execute("""
+        UPDATE history SET
+            seq = (SELECT seq FROM history_seq WHERE rid = history.rowid),
+            slot = (SELECT seq FROM history_seq WHERE rid = history.rowid)
+    """)
+    cursor.execute("DROP TABLE history_seq")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_history_user_slot ON history (user_id, slot)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_history_user_seq ON history (user_id, seq)")
+
+def migration_charts(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS charts (
+            name TEXT PRIMARY KEY,
+            generated_at REAL
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS chart_entries (
+            chart TEXT,
+            position INTEGER,
+            video_id TEXT,
+            PRIMARY KEY (chart, position)
+        )
+    """)
+
+def migration_audio_file_formats(cursor):
+    # file_id is per encoded file, so free and premium renditions need their own rows
+    cursor.execute("""
+        CREATE TABLE audio_files_new (
+            video_id TEXT,
+            format TEXT,
+            file_id TEXT,
+            file_unique_id TEXT,
+            created_at TEXT,
+            PRIMARY KEY (video_id, format)
+        )
+    """)
+    cursor.execute(f"""
+        INSERT INTO audio_files_new (video_id, format, file_id, file_unique_id, created_at)
+        SELECT video_id, '{AUDIO_SOURCE_FORMAT}', file_id, file_unique_id, created_at FROM audio_files
+    """)
+    cursor.execute("DROP TABLE audio_files")
+    cursor.execute("ALTER TABLE audio_files_new RENAME TO audio_files")
+
+def migration_fsm_storage(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS fsm_storage (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            expires_at REAL NOT NULL
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_fsm_storage_expires ON fsm_storage (expires_at)")
+
+def migration_broadcast_lease(cursor):
+    # The worker running a broadcast holds it until lease_until; it is renewed with every saved chunk
+    cursor.execute("ALTER TABLE broadcasts ADD COLUMN owner TEXT")
+    cursor.execute("ALTER TABLE broadcasts ADD COLUMN lease_until REAL")
+
+def migration_result_sets(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS result_sets (
+            token TEXT PRIMARY KEY,
+            rows TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_result_sets_expires ON result_sets (expires_at)")
+
+def migration_audio_cache_index(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS audio_cache (
+            video_id TEXT NOT NULL,
+            format TEXT NOT NULL,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            accessed_at REAL NOT NULL,
+            PRIMARY KEY (video_id, format)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_audio_cache_accessed ON audio_cache (accessed_at)")
+
+def migration_subscriptions(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            user_id INTEGER PRIMARY KEY,
+            subscribed INTEGER NOT NULL,
+            checked_at REAL NOT NULL
+        )
+    """)
+
+MIGRATIONS = [
+    migration_base_schema,
+    migration_total_downloads,
+    migration_cache_tables,
+    migration_broadcasts,
+    migration_indexes,
+    migration_unique_favorites,
+    migration_history_ring,
+    migration_charts,
+    migration_audio_file_formats,
+    migration_fsm_storage,
+    migration_broadcast_lease,
+    migration_result_sets,
+    migration_audio_cache_index,
+    migration_subscriptions,
+]
+
+def configure_connection(connection):
+    # busy_timeout first: switching a fresh file to WAL takes a lock that other workers may be holding
+    connection.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+
+def run_migrations(connection):
+    for number, migration in enumerate(MIGRATIONS, start=1):
+        # Workers starting together race here; the version is re-read under the write lock
+        connection.execute("BEGIN IMMEDIATE")
+        if connection.execute("PRAGMA user_version").fetchone()[0] >= number:
+            connection.execute("COMMIT")
+            continue
+        logger.info(f"Applying database migration {number}: {migration.__name__}")
+        try:
+            migration(connection.cursor())
+            connection.execute(f"PRAGMA user_version = {number}")
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+WriteResult = namedtuple('WriteResult', ['lastrowid', 'rowcount'])
+
+def write_execute(cursor, sql, params):
+    cursor.execute(sql, params)
+    return WriteResult(cursor.lastrowid, cursor.rowcount)
+
+def write_executemany(cursor, sql, rows):
+    cursor.executemany(sql, rows)
+    return WriteResult(cursor.lastrowid, cursor.rowcount)
+
+def read_fetchone(connection, sql, params):
+    return connection.execute(sql, params).fetchone()
+
+def read_fetchall(connection, sql, params):
+    return connection.execute(sql, params).fetchall()
+
+class Database:
+    def __init__(self, path, readers, batch_size):
+        self.path = path
+        self.readers = readers
+        self.batch_size = batch_size
+        self.read_executor = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='db-read')
+        self.write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-write')
+        self.read_pool = None
+        self.write_queue = None
+        self.write_conn = None
+        self.writer = None
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        configure_connection(connection)
+        return connection
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.write_conn = await loop.run_in_executor(self.write_executor, self.connect)
+        await loop.run_in_executor(self.write_executor, run_migrations, self.write_conn)
+        self.read_pool = asyncio.Queue()
+        for _ in range(self.readers):
+            self.read_pool.put_nowait(await loop.run_in_executor(self.read_executor, self.connect))
+        self.write_queue = asyncio.Queue()
+        self.writer = asyncio.create_task(self.write_loop())
+
+    async def close(self):
+        if self.writer:
+            await self.write_queue.put(None)
+            await self.writer
+        while self.read_pool and not self.read_pool.empty():
+            self.read_pool.get_nowait().close()
+        if self.write_conn:
+            self.write_conn.close()
+
+    async def read(self, func, sql, params):
+        connection = await self.read_pool.get()
+        try:
+            future = asyncio.get_running_loop().run_in_executor(self.read_executor, func, connection, sql, params)
+        except BaseException:
+            self.read_pool.put_nowait(connection)
+            raise
+        # Returned once the thread is done with it; a cancelled caller would otherwise hand out a busy connection
+        future.add_done_callback(functools.partial(self.release, connection))
+        return await asyncio.shield(future)
+
+    def release(self, connection, future):
+        self.read_pool.put_nowait(connection)
+        if not future.cancelled():
+            # Nobody awaits the result when the caller was cancelled
+            future.exception()
+
+    async def fetchone(self, sql, params=()):
+        return await self.read(read_fetchone, sql, params)
+
+    async def fetchall(self, sql, params=()):
+        return await self.read(read_fetchall, sql, params)
+
+    async def fetchval(self, sql, params=()):
+        row = await self.fetchone(sql, params)
+        return row[0] if row else None
+
+    async def transaction(self, func, *args):
+        future = asyncio.get_running_loop().create_future()
+        await self.write_queue.put((func, args, future))
+        return await future
+
+    async def execute(self, sql, params=()):
+        return await self.transaction(write_execute, sql, params)
+
+    async def executemany(self, sql, rows):
+        return await self.transaction(write_executemany, sql, rows)
+
+    async def write_loop(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self.write_queue.get()
+            if item is None:
+                break
+            batch = [item]
+            while len(batch) < self.batch_size and not self.write_queue.empty():
+                item = self.write_queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            try:
+                results = await loop.run_in_executor(self.write_executor, self.apply_batch, batch)
+            except Exception as e:
+                logger.error(f"Database write batch of {len(batch)} failed: {e}")
+                results = [(False, e)] * len(batch)
+            for (_, _, future), (ok, value) in zip(batch, results):
+                if future.cancelled():
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    def apply_batch(self, batch):
+        # One commit for the whole batch; a failing write only rolls back its own savepoint
+        cursor = self.write_conn.cursor()
+        results = []
+        cursor.execute("BEGIN")
+        try:
+            for func, args, _ in batch:
+                cursor.execute("SAVEPOINT write")
+                try:
+                    results.append((True, func(cursor, *args)))
+                    cursor.execute("RELEASE write")
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO write")
+                    cursor.execute("RELEASE write")
+                    results.append((False, e))
+            cursor.execute("COMMIT")
+        except Exception:
+            if self.write_conn.in_transaction:
+                cursor.execute("ROLLBACK")
+            raise
+        return results
+
+db = Database(DB_PATH, DB_READERS, DB_WRITE_BATCH_SIZE)
+
+def dump_fsm_data(data):
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+def fsm_clear_expired(cursor, key, now):
+    cursor.execute("DELETE FROM fsm_storage WHERE key = ? AND expires_at <= ?", (key, now))
+
+def fsm_write(cursor, key, column, value, now, ttl):
+    fsm_clear_expired(cursor, key, now)
+    cursor.execute(
+        f"INSERT INTO fsm_storage (key, {column}, expires_at) VALUES (?, ?, ?) "
+        f"ON CONFLICT(key) DO UPDATE SET {column} = excluded.{column}, expires_at = excluded.expires_at",
+        (key, value, now + ttl)
     )
-""")
+    # Nothing left to remember once the state is cleared and the data emptied
+    cursor.execute("DELETE FROM fsm_storage WHERE key = ? AND state IS NULL AND data = '{}'", (key,))
+
+def fsm_update_data(cursor, key, data, now, ttl):
+    fsm_clear_expired(cursor, key, now)
+    row = cursor.execute("SELECT data FROM fsm_storage WHERE key = ?", (key,)).fetchone()
+    merged = json.loads(row[0]) if row else {}
+    merged.update(data)
+    fsm_write(cursor, key, 'data', dump_fsm_data(merged), now, ttl)
+    return merged
+
+class SQLiteStorage(BaseStorage):
+    # FSM state on the shared WAL database, so any worker process can continue a conversation
+    def __init__(self, ttl):
+        self.ttl = ttl
+
+    @staticmethod
+    def build_key(key):
+        return (f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:"
+                f"{key.business_connection_id or ''}:{key.destiny}")
+
+    async def read(self, key, column):
+        return await db.fetchval(
+            f"SELECT {column} FROM fsm_storage WHERE key = ? AND expires_at > ?", (self.build_key(key), time.time())
+        )
 
-cursor.execute("""
-    CREATE TABLE IF NOT EXISTS bot_status (
-        id INTEGER PRIMARY KEY,
-        is_disabled BOOLEAN DEFAULT FALSE,
-        disabled_until TEXT
-    )
-""")
+    async def set_state(self, key, state=None):
+        value = state.state if isinstance(state, State) else state
+        await db.transaction(fsm_write, self.build_key(key), 'state', value, time.time(), self.ttl)
+
+    async def get_state(self, key):
+        return await self.read(key, 'state')
+
+    async def set_data(self, key, data):
+        await db.transaction(fsm_write, self.build_key(key), 'data', dump_fsm_data(dict(data)), time.time(), self.ttl)
+
+    async def get_data(self, key):
+        data = await self.read(key, 'data')
+        return json.loads(data) if data else {}
+
+    async def update_data(self, key, data):
+        # Merged inside the writer so concurrent updates from other workers are not lost
+        return await db.transaction(fsm_update_data, self.build_key(key), dict(data), time.time(), self.ttl)
+
+    async def purge(self):
+        result = await db.execute("DELETE FROM fsm_storage WHERE expires_at <= ?", (time.time(),))
+        if result.rowcount:
+            logger.info(f"Purged {result.rowcount} expired FSM entries")
+
+    async def close(self):
+        # The database is closed by on_shutdown
+        pass
 
-cursor.execute("INSERT OR IGNORE INTO bot_status (id, is_disabled) VALUES (1, FALSE)")
-conn.commit()
+fsm_storage = SQLiteStorage(FSM_TTL)
+fsm_purge_task = None
+
+async def purge_fsm_periodically():
+    while True:
+        await asyncio.sleep(FSM_PURGE_INTERVAL)
+        try:
+            await fsm_storage.purge()
+            await db.execute("DELETE FROM result_sets WHERE expires_at < ?", (time.time(),))
+            await subscription_cache.purge()
+        except Exception as e:
+            logger.error(f"Error purging FSM storage: {e}")
+
+dp = Dispatcher(storage=fsm_storage)
+
+class LoopLagMonitor:
+    def __init__(self, interval):
+        self.interval = interval
+        self.max_lag = 0.0
+        self.avg_lag = 0.0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - started - self.interval)
+            self.max_lag = max(self.max_lag, lag)
+            self.avg_lag = self.avg_lag * 0.9 + lag * 0.1
+            if lag > LOOP_LAG_WARNING:
+                logger.warning(f"Event loop stalled for {lag * 1000:.0f} ms")
+
+    def stats(self):
+        return {'max_ms': self.max_lag * 1000, 'avg_ms': self.avg_lag * 1000}
+
+loop_lag_monitor = LoopLagMonitor(LOOP_LAG_INTERVAL)
+loop_lag_task = None
 
 class SearchStates(StatesGroup):
     searching = State()
@@ -166,27 +696,57 @@ class AdminStates(StatesGroup):
     waiting_for_premium_days = State()
     waiting_for_disable_duration = State()
 
-def get_user(uid):
-    cursor.execute("SELECT * FROM users WHERE id = ?", (uid,))
-    user = cursor.fetchone()
-    if not user:
-        cursor.execute("INSERT INTO users (id) VALUES (?)", (uid,))
-        conn.commit()
-    return True
-
-def update_user(uid, **kwargs):
+USER_FIELDS = ('balance', 'referrals', 'lang', 'premium_until', 'is_new_user', 'referrer_id')
+
+class UserRecord:
+    __slots__ = ('id', 'balance', 'referrals', 'lang', 'premium_until', 'is_new_user', 'referrer_id', 'dirty')
+
+    def __init__(self, uid, balance=0, referrals=0, lang='Русский', premium_until=None, is_new_user=True,
+                 referrer_id=None):
+        self.id = uid
+        self.balance = balance
+        self.referrals = referrals
+        self.lang = lang
+        self.premium_until = premium_until
+        self.is_new_user = is_new_user
+        self.referrer_id = referrer_id
+        self.dirty = set()
+
+    def set(self, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+            self.dirty.add(key)
+
+async def load_user(uid):
+    row = await db.fetchone(f"SELECT {', '.join(USER_FIELDS)} FROM users WHERE id = ?", (uid,))
+    return UserRecord(uid, *row) if row else None
+
+async def get_user(uid):
+    row = await db.fetchone(
+        f"SELECT {', '.join(USER_FIELDS)}, action_count, total_downloads FROM users WHERE id = ?", (uid,)
+    )
+    if not row:
+        await db.execute("INSERT OR IGNORE INTO users (id) VALUES (?)", (uid,))
+        row = (0, 0, 'Русский', None, True, None, 0, 0)
+    counter_store.pin(uid, row[-2], row[-1])
+    return UserRecord(uid, *row[:-2])
+
+async def save_user(user):
+    if user.dirty:
+        dirty = {field: getattr(user, field) for field in user.dirty}
+        user.dirty.clear()
+        await update_user(user.id, **dirty)
+
+async def update_user(uid, **kwargs):
     keys, values = zip(*kwargs.items())
     fields = ', '.join(f"{k} = ?" for k in keys)
-    cursor.execute(f"UPDATE users SET {fields} WHERE id = ?", (*values, uid))
-    conn.commit()
+    await db.execute(f"UPDATE users SET {fields} WHERE id = ?", (*values, uid))
 
-def get_user_field(uid, field):
-    cursor.execute(f"SELECT {field} FROM users WHERE id = ?", (uid,))
-    res = cursor.fetchone()
-    return res[0] if res else None
+def get_user_field(user, field):
+    return getattr(user, field)
 
-def has_premium(uid):
-    p = get_user_field(uid, 'premium_until')
+def has_premium(user):
+    p = user.premium_until
     if not p:
         return False
     try:
@@ -194,24 +754,118 @@ def has_premium(uid):
     except ValueError:
         return False
 
-def can_download(uid):
-    if has_premium(uid):
+class UserMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        from_user = data.get('event_from_user')
+        if from_user is None:
+            return await handler(event, data)
+        user = await get_user(from_user.id)
+        data['user'] = user
+        try:
+            return await handler(event, data)
+        finally:
+            counter_store.unpin(user.id)
+            await save_user(user)
+
+dp.message.middleware(UserMiddleware())
+dp.callback_query.middleware(UserMiddleware())
+
+class CounterStore:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.counters = {}
+        # Unflushed changes per user; other workers change the same rows, so only deltas are written back
+        self.pending = {}
+        self.pins = {}
+
+    def pin(self, uid, action_count, total_downloads):
+        # Re-seeded from the row UserMiddleware loads for every update, which picks up other workers' flushes
+        self.pins[uid] = self.pins.get(uid, 0) + 1
+        pending = self.pending.get(uid, (0, 0))
+        self.counters[uid] = [max(0, (action_count or 0) + pending[0]), (total_downloads or 0) + pending[1]]
+
+    def unpin(self, uid):
+        if self.pins.get(uid, 0) <= 1:
+            self.pins.pop(uid, None)
+        else:
+            self.pins[uid] -= 1
+
+    def _load(self, uid):
+        return self.counters[uid]
+
+    def _change(self, uid, action_delta, downloads_delta):
+        counters = self._load(uid)
+        counters[0] += action_delta
+        counters[1] += downloads_delta
+        pending = self.pending.setdefault(uid, [0, 0])
+        pending[0] += action_delta
+        pending[1] += downloads_delta
+
+    def action_count(self, uid):
+        return self._load(uid)[0]
+
+    def total_downloads(self, uid):
+        return self._load(uid)[1]
+
+    def increment_action_count(self, uid):
+        self._change(uid, 1, 0)
+
+    def reset_action_count(self, uid):
+        self._change(uid, -self.action_count(uid), 0)
+
+    def increment_downloads(self, uid):
+        self._change(uid, 0, 1)
+
+    async def flush(self):
+        if self.pending:
+            pending, self.pending = self.pending, {}
+            rows = [(actions, downloads, uid) for uid, (actions, downloads) in pending.items()]
+            try:
+                await db.executemany(
+                    """
+                    UPDATE users SET action_count = MAX(0, action_count + ?), total_downloads = total_downloads + ?
+                    WHERE id = ?
+                    """,
+                    rows
+                )
+            except Exception:
+                for uid, (actions, downloads) in pending.items():
+                    merged = self.pending.setdefault(uid, [0, 0])
+                    merged[0] += actions
+                    merged[1] += downloads
+                raise
+            logger.info(f"Flushed counters for {len(rows)} users")
+        # Clean entries can be dropped; pinned ones are in use by a running handler
+        if len(self.counters) > self.max_size:
+            for uid in [uid for uid in self.counters if uid not in self.pending and uid not in self.pins]:
+                del self.counters[uid]
+
+counter_store = CounterStore(COUNTER_CACHE_SIZE)
+counter_flush_task = None
+
+async def flush_counters_periodically():
+    while True:
+        await asyncio.sleep(COUNTER_FLUSH_INTERVAL)
+        try:
+            await counter_store.flush()
+        except Exception as e:
+            logger.error(f"Error flushing counters: {e}")
+
+def can_download(user):
+    if has_premium(user):
         return True
-    total_downloads = get_user_field(uid, 'total_downloads') or 0
-    return total_downloads < 30  # Free users limited to 30 tracks
+    return counter_store.total_downloads(user.id) < 30  # Free users limited to 30 tracks
 
-def should_send_ad(uid):
-    if has_premium(uid):
+def should_send_ad(user):
+    if has_premium(user):
         return False
-    action_count = get_user_field(uid, 'action_count') or 0
-    return action_count >= AD_ACTION_THRESHOLD
+    return counter_store.action_count(user.id) >= AD_ACTION_THRESHOLD
 
 def reset_action_count(uid):
-    update_user(uid, action_count=0)
+    counter_store.reset_action_count(uid)
 
 def increment_action_count(uid):
-    current_count = get_user_field(uid, 'action_count') or 0
-    update_user(uid, action_count=current_count + 1)
+    counter_store.increment_action_count(uid)
 
 def send_ad_text():
     ads = [
@@ -231,11 +885,6 @@ def format_duration(duration):
     except (TypeError, ValueError):
         return "??:??"
 
-def sanitize_filename(name: str) -> str:
-    if not isinstance(name, str):
-        name = str(name)
-    return re.sub(r'[^\w\-_\. ]', '_', name)[:100]
-
 def youtube_match_filter(info, *, incomplete):
     title = info.get('title', '').lower()
     duration = info.get('duration')
@@ -245,7 +894,230 @@ def youtube_match_filter(info, *, incomplete):
         return "Исключено: видео, стрим или не музыка"
     return None
 
+class StageBusyError(Exception):
+    pass
+
+class StagePool:
+    def __init__(self, name, workers, queue_timeout):
+        self.name = name
+        self.queue_timeout = queue_timeout
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"ytdlp-{name}")
+        self.semaphore = asyncio.Semaphore(workers)
+        self.waiting = 0
+        self.active = 0
+
+    async def run(self, func, *args, **kwargs):
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Stage '{self.name}' queue timeout after {self.queue_timeout}s")
+            raise StageBusyError(f"Очередь '{self.name}' переполнена")
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+        finally:
+            self.active -= 1
+            self.semaphore.release()
+
+search_pool = StagePool('search', SEARCH_WORKERS, SEARCH_QUEUE_TIMEOUT)
+metadata_pool = StagePool('metadata', METADATA_WORKERS, METADATA_QUEUE_TIMEOUT)
+transcode_pool = StagePool('transcode', TRANSCODE_WORKERS, TRANSCODE_QUEUE_TIMEOUT)
+download_pool = StagePool('download', DOWNLOAD_WORKERS, DOWNLOAD_QUEUE_TIMEOUT)
+
+def ydl_extract_info(ydl_opts, url):
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        return ydl.extract_info(url, download=False)
+
+class DownloadError(Exception):
+    pass
+
+def estimate_format_size(fmt, duration):
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if size:
+        return size
+    bitrate = fmt.get('abr') or fmt.get('tbr')
+    if bitrate and duration:
+        return int(bitrate * 1000 / 8 * duration)
+    return None
+
+def pick_audio_format(formats, duration, max_bytes):
+    audio = [f for f in formats if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')]
+    if not audio:
+        raise DownloadError("у видео нет отдельной аудиодорожки")
+    audio.sort(key=lambda f: f.get('abr') or f.get('tbr') or 0, reverse=True)
+    sized = [(f, estimate_format_size(f, duration)) for f in audio]
+    known = [(f, size) for f, size in sized if size]
+    if not known:
+        # Nothing to go on; take the best and let the post-download check decide
+        return audio[0]
+    for fmt, size in known:
+        if size <= max_bytes:
+            return fmt
+    smallest = min(size for _, size in known)
+    raise DownloadError(
+        f"трек слишком большой: даже самый лёгкий аудиоформат весит ~{smallest / (1024 * 1024):.0f} МБ "
+        f"при лимите {max_bytes // (1024 * 1024)} МБ"
+    )
+
+def ydl_download_fitting(ydl_opts, url, max_bytes):
+    # Read the format list first so oversized tracks are rejected before any audio is transferred
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=False, process=False)
+        fmt = pick_audio_format(info.get('formats') or [], info.get('duration'), max_bytes)
+        # The selector is compiled in YoutubeDL.__init__, so changing params['format'] alone has no effect
+        ydl.params['format'] = fmt['format_id']
+        ydl.format_selector = ydl.build_format_selector(fmt['format_id'])
+        return ydl.process_ie_result(info, download=True)
+
+async def extract_track_info(video_id):
+    ydl_opts = {'quiet': True, 'nocheckcertificate': True}
+    info = await metadata_pool.run(ydl_extract_info, ydl_opts, f"https://www.youtube.com/watch?v={video_id}")
+    return {
+        'video_id': video_id,
+        'title': info.get('title', 'Unknown'),
+        'artist': info.get('uploader', 'Unknown Artist'),
+        'duration': format_duration(info.get('duration'))
+    }
+
+class TrackStore:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.cache = OrderedDict()
+
+    def _remember(self, track, updated_at):
+        video_id = track['video_id']
+        self.cache[video_id] = (track, updated_at)
+        self.cache.move_to_end(video_id)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+    async def lookup(self, video_id):
+        entry = self.cache.get(video_id)
+        if entry:
+            self.cache.move_to_end(video_id)
+            return entry
+        row = await db.fetchone("SELECT title, artist, duration, updated_at FROM tracks WHERE video_id = ?", (video_id,))
+        if not row:
+            return None
+        title, artist, duration, updated_at = row
+        track = {'video_id': video_id, 'title': title, 'artist': artist, 'duration': duration}
+        self._remember(track, updated_at or 0)
+        return self.cache[video_id]
+
+    async def put_many(self, tracks):
+        now = time.time()
+        rows = []
+        for item in tracks:
+            track = {key: item[key] for key in ('video_id', 'title', 'artist', 'duration')}
+            known = self.cache.get(track['video_id'])
+            # Flat search entries often lack duration; keep the one we already know
+            if track['duration'] == "??:??" and known:
+                track['duration'] = known[0]['duration']
+            self._remember(track, now)
+            rows.append((track['video_id'], track['title'], track['artist'], track['duration'], now))
+        if not rows:
+            return
+        await db.executemany(
+            """
+            INSERT INTO tracks (video_id, title, artist, duration, updated_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(video_id) DO UPDATE SET
+                title = excluded.title,
+                artist = excluded.artist,
+                duration = CASE WHEN excluded.duration = '??:??' THEN tracks.duration ELSE excluded.duration END,
+                updated_at = excluded.updated_at
+            """, rows)
+
+    async def get(self, video_id):
+        entry = await self.lookup(video_id)
+        if entry:
+            track, updated_at = entry
+            if time.time() - updated_at < self.ttl and track['duration'] != "??:??":
+                return track
+        try:
+            track = await extract_track_info(video_id)
+        except Exception as e:
+            if not entry:
+                raise
+            logger.warning(f"Failed to refresh metadata for {video_id}, using cached copy: {e}")
+            return entry[0]
+        await self.put_many([track])
+        return track
+
+track_store = TrackStore(TRACK_CACHE_SIZE, TRACK_CACHE_TTL)
+
+def normalize_query(query):
+    return ' '.join(query.lower().split())
+
+class SearchCache:
+    def __init__(self, max_size, ttl, stale_ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.entries = OrderedDict()
+        self.refreshing = {}
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if not entry:
+            return None, False
+        results, fetched_at = entry
+        age = time.time() - fetched_at
+        if age > self.stale_ttl:
+            del self.entries[key]
+            return None, False
+        self.entries.move_to_end(key)
+        return results, age > self.ttl
+
+    def put(self, key, results):
+        self.entries[key] = (results, time.time())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def refresh(self, key, fetch):
+        if key in self.refreshing:
+            return
+        self.refreshing[key] = asyncio.create_task(self._refresh(key, fetch))
+
+    async def _refresh(self, key, fetch):
+        try:
+            self.put(key, await fetch())
+        except Exception as e:
+            logger.warning(f"Background refresh failed for search {key}: {e}")
+        finally:
+            self.refreshing.pop(key, None)
+
+search_cache = SearchCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL, SEARCH_CACHE_STALE_TTL)
+
 async def youtube_search(query: str, max_results=20, max_duration=600, exclude_playlists=True, is_fallback=False):
+    try:
+        return await cached_youtube_search(query, max_results, max_duration, exclude_playlists, is_fallback)
+    except StageBusyError:
+        # An overloaded search pool is not an empty result; the handler tells the user to retry
+        raise
+    except Exception as e:
+        logger.error(f"Error searching YouTube for query '{query}': {str(e)}")
+        return []
+
+async def cached_youtube_search(query, max_results, max_duration, exclude_playlists, is_fallback):
+    query = normalize_query(query)
+    key = (query, max_results, is_fallback)
+    fetch = functools.partial(fetch_youtube_search, query, max_results, max_duration, exclude_playlists, is_fallback)
+    results, stale = search_cache.get(key)
+    if results is None:
+        results = await fetch()
+        search_cache.put(key, results)
+    elif stale:
+        search_cache.refresh(key, fetch)
+    return list(results)
+
+async def fetch_youtube_search(query, max_results, max_duration, exclude_playlists, is_fallback):
     ydl_opts = {
         'quiet': True,
         'skip_download': True,
@@ -256,155 +1128,1130 @@ async def youtube_search(query: str, max_results=20, max_duration=600, exclude_p
         'match_filter': youtube_match_filter,
         'noplaylist': exclude_playlists
     }
+    search_query = f"{query} официальный аудио музыка" if not is_fallback else f"{query} русские хиты музыка"
+    info = await search_pool.run(ydl_extract_info, ydl_opts, search_query)
+    entries = info.get('entries', [])
+    results = []
+    for e in entries:
+        vid = e.get('id')
+        title = e.get('title', 'Unknown Title')
+        duration = e.get('duration')
+        artist = e.get('uploader', 'Unknown Artist')
+        if not vid or not title: 
+            logger.warning(f"Skipping invalid entry: {e}")
+            continue
+        duration_str = format_duration(duration)
+        results.append({
+            'video_id': vid,
+            'title': title,
+            'artist': artist,
+            'duration': duration_str
+        })
+    logger.info(f"Found {len(results)} tracks for query: {query} (fallback: {is_fallback})")
+    await track_store.put_many(results)
+
+    if not results and not is_fallback:
+        logger.info(f"No results for query: {query}, trying fallback search")
+        return await cached_youtube_search(query, max_results, max_duration, exclude_playlists, is_fallback=True)
+    return results
+
+async def search_branch(query, max_results):
+    # Bypasses the search cache: fan-out only builds charts, which must be fresh on every refresh
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            search_query = f"{query} официальный аудио музыка" if not is_fallback else f"{query} русские хиты музыка"
-            info = ydl.extract_info(search_query, download=False)
-            entries = info.get('entries', [])
-            results = []
-            for e in entries:
-                vid = e.get('id')
-                title = e.get('title', 'Unknown Title')
-                duration = e.get('duration')
-                artist = e.get('uploader', 'Unknown Artist')
-                if not vid or not title: 
-                    logger.warning(f"Skipping invalid entry: {e}")
-                    continue
-                duration_str = format_duration(duration)
-                results.append({
-                    'video_id': vid,
-                    'title': title,
-                    'artist': artist,
-                    'duration': duration_str
-                })
-            logger.info(f"Found {len(results)} tracks for query: {query} (fallback: {is_fallback})")
-            
-            if not results and not is_fallback:
-                logger.info(f"No results for query: {query}, trying fallback search")
-                return await youtube_search(query, max_results, max_duration, exclude_playlists, is_fallback=True)
-            return results
+        return await fetch_youtube_search(normalize_query(query), max_results, 600, True, False)
     except Exception as e:
         logger.error(f"Error searching YouTube for query '{query}': {str(e)}")
         return []
 
-async def download_audio(video_id, title=None):
-    if not os.path.exists('temp'):
-        os.makedirs('temp')
-    filename = sanitize_filename(title or video_id)
-    output_file = f"temp/{filename}.webm"
-    if os.path.exists(output_file):
-        return output_file
+def interleave_results(branches, max_results):
+    seen = set()
+    results = []
+    for row in range(max((len(branch) for branch in branches), default=0)):
+        for branch in branches:
+            if row < len(branch) and branch[row]['video_id'] not in seen:
+                seen.add(branch[row]['video_id'])
+                results.append(branch[row])
+                if len(results) >= max_results:
+                    return results
+    return results
+
+async def fan_out_search(queries, max_results=20, per_query=FAN_OUT_PER_QUERY, deadline=FAN_OUT_DEADLINE):
+    semaphore = asyncio.Semaphore(FAN_OUT_CONCURRENCY)
+
+    async def branch(query):
+        async with semaphore:
+            return await search_branch(query, per_query)
+
+    tasks = [asyncio.create_task(branch(query)) for query in queries]
+    done, pending = await asyncio.wait(tasks, timeout=deadline)
+    if pending:
+        # Late branches keep running so their results still land in the track cache
+        logger.warning(f"Fan-out search returned partial results: {len(pending)}/{len(tasks)} branches timed out")
+    branches = [task.result() for task in tasks if task in done]
+    return interleave_results(branches, max_results)
+
+class SingleFlight:
+    def __init__(self):
+        self.inflight = {}
+
+    async def run(self, key, factory):
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self.inflight[key] = task
+            task.add_done_callback(functools.partial(self._done, key))
+        # A cancelled waiter must not cancel the shared task
+        return await asyncio.shield(task)
+
+    def _done(self, key, task):
+        if self.inflight.get(key) is task:
+            del self.inflight[key]
+        if not task.cancelled():
+            task.exception()
+
+download_flights = SingleFlight()
+
+def index_audio_files(cursor, entries):
+    # Files from before the shared index, or left by a worker that died between rename and insert
+    cursor.executemany(
+        "INSERT OR IGNORE INTO audio_cache (video_id, format, path, size, accessed_at) VALUES (?, ?, ?, ?, ?)",
+        entries
+    )
+    rows = cursor.execute("SELECT video_id, format, path FROM audio_cache").fetchall()
+    missing = [(video_id, fmt) for video_id, fmt, path in rows if not os.path.exists(path)]
+    cursor.executemany("DELETE FROM audio_cache WHERE video_id = ? AND format = ?", missing)
+
+def evict_audio_files(cursor, max_bytes, keep, touched_before):
+    total = cursor.execute("SELECT COALESCE(SUM(size), 0) FROM audio_cache").fetchone()[0]
+    if total <= max_bytes:
+        return 0
+    evicted = 0
+    # Recently used files are skipped: another worker may be uploading one of them right now
+    rows = cursor.execute(
+        "SELECT video_id, format, path, size FROM audio_cache WHERE accessed_at < ? ORDER BY accessed_at",
+        (touched_before,)
+    ).fetchall()
+    for video_id, fmt, path, size in rows:
+        if total <= max_bytes:
+            break
+        if (video_id, fmt) == keep:
+            continue
+        cursor.execute("DELETE FROM audio_cache WHERE video_id = ? AND format = ?", (video_id, fmt))
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        evicted += 1
+    return evicted
+
+class AudioCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        # Workers share the cache directory but each downloads into its own staging directory
+        self.staging = os.path.join(directory, '.staging', WORKER_ID)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def scan(self):
+        os.makedirs(self.staging, exist_ok=True)
+        # Peers may still be downloading; besides this worker's own leftovers only stale files are removed
+        now = time.time()
+        root = os.path.dirname(self.staging)
+        for path, _, names in os.walk(root, topdown=False):
+            for name in names:
+                staged_file = os.path.join(path, name)
+                try:
+                    if path == self.staging or now - os.path.getmtime(staged_file) > AUDIO_STAGING_MAX_AGE:
+                        os.remove(staged_file)
+                except FileNotFoundError:
+                    pass
+            if path not in (root, self.staging):
+                try:
+                    os.rmdir(path)
+                except OSError:
+                    pass
+        entries = []
+        for entry in os.scandir(self.directory):
+            parts = entry.name.split('.')
+            if not entry.is_file() or len(parts) != 3:
+                continue
+            video_id, fmt, _ = parts
+            stat = entry.stat()
+            entries.append((video_id, fmt, entry.path, stat.st_size, stat.st_atime))
+        await db.transaction(index_audio_files, entries)
+        await self.evict()
+        stats = await self.stats()
+        logger.info(f"Audio cache: {stats['files']} files, {stats['bytes']} bytes in {self.directory}")
+
+    async def lookup(self, video_id, fmt):
+        path = await db.fetchval("SELECT path FROM audio_cache WHERE video_id = ? AND format = ?", (video_id, fmt))
+        if path and not os.path.exists(path):
+            await db.execute("DELETE FROM audio_cache WHERE video_id = ? AND format = ? AND path = ?",
+                             (video_id, fmt, path))
+            return None
+        return path
+
+    async def get(self, video_id, fmt):
+        # The index lives in the shared database, so files downloaded by any worker are hits
+        path = await self.lookup(video_id, fmt)
+        if not path:
+            self.misses += 1
+            return None
+        self.hits += 1
+        await db.execute("UPDATE audio_cache SET accessed_at = ? WHERE video_id = ? AND format = ?",
+                         (time.time(), video_id, fmt))
+        return path
+
+    def staging_path(self, video_id, fmt):
+        return os.path.join(self.staging, f"{video_id}.{fmt}")
+
+    async def commit(self, video_id, fmt, staged_file):
+        ext = os.path.splitext(staged_file)[1]
+        path = os.path.join(self.directory, f"{video_id}.{fmt}{ext}")
+        old = await db.fetchval("SELECT path FROM audio_cache WHERE video_id = ? AND format = ?", (video_id, fmt))
+        os.replace(staged_file, path)
+        await db.execute(
+            "INSERT OR REPLACE INTO audio_cache (video_id, format, path, size, accessed_at) VALUES (?, ?, ?, ?, ?)",
+            (video_id, fmt, path, os.path.getsize(path), time.time())
+        )
+        if old and old != path and os.path.exists(old):
+            os.remove(old)
+        await self.evict(keep=(video_id, fmt))
+        return path
+
+    async def evict(self, keep=None):
+        self.evictions += await db.transaction(
+            evict_audio_files, self.max_bytes, keep, time.time() - AUDIO_CACHE_MIN_IDLE
+        )
+
+    async def stats(self):
+        files, total_bytes = await db.fetchone("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM audio_cache")
+        return {
+            'files': files,
+            'bytes': total_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+audio_cache = AudioCache(AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_BYTES)
+
+download_stats = {'downloaded_bytes': 0, 'wasted_bytes': 0, 'rejected': 0}
+
+async def download_audio(video_id):
+    try:
+        return await download_flights.run(video_id, functools.partial(fetch_audio, video_id))
+    except DownloadError:
+        raise
+    except Exception as e:
+        logger.error(f"Error downloading audio: {e}")
+        return None
+
+async def fetch_audio(video_id):
+    cached = await audio_cache.get(video_id, AUDIO_SOURCE_FORMAT)
+    if cached:
+        return cached
     ydl_opts = {
-        'format': 'bestaudio',
-        'outtmpl': f"temp/{filename}.%(ext)s",
+        'format': AUDIO_SOURCE_FORMAT,
+        'outtmpl': audio_cache.staging_path(video_id, AUDIO_SOURCE_FORMAT) + '.%(ext)s',
         'quiet': True,
-        'nocheckcertificate': true,
+        'nocheckcertificate': True,
     }
+    url = f"https://www.youtube.com/watch?v={video_id}"
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            url = f"https://www.youtube.com/watch?v={video_id}"
-            ydl.download([url])
-        if os.path.getsize(output_file) > MAX_FILE_SIZE:
-            os.remove(output_file)
-            return None
-        return output_file
+        info = await download_pool.run(ydl_download_fitting, ydl_opts, url, MAX_FILE_SIZE)
+    except DownloadError as e:
+        download_stats['rejected'] += 1
+        logger.info(f"Rejected {video_id} before download: {e}")
+        raise
+    staged_file = info['requested_downloads'][0]['filepath']
+    size = os.path.getsize(staged_file)
+    download_stats['downloaded_bytes'] += size
+    if size > MAX_FILE_SIZE:
+        # The size estimate was wrong; the transfer is wasted
+        download_stats['wasted_bytes'] += size
+        os.remove(staged_file)
+        raise DownloadError(f"файл оказался больше лимита {MAX_FILE_SIZE // (1024 * 1024)} МБ")
+    return await audio_cache.commit(video_id, AUDIO_SOURCE_FORMAT, staged_file)
+
+TRANSCODE_CODECS = {
+    'mp3': ('libmp3lame', '.mp3', ['-id3v2_version', '3']),
+    'opus': ('libopus', '.ogg', []),
+}
+
+@functools.lru_cache(maxsize=None)
+def ffmpeg_available():
+    available = shutil.which(FFMPEG_BINARY) is not None
+    if TRANSCODE_ENABLED and not available:
+        logger.warning(f"{FFMPEG_BINARY} not found, sending source audio without transcoding")
+    return available
+
+def audio_format_for(premium):
+    if not TRANSCODE_ENABLED or not ffmpeg_available():
+        return AUDIO_SOURCE_FORMAT
+    bitrate = TRANSCODE_PREMIUM_BITRATE if premium else TRANSCODE_FREE_BITRATE
+    return f"{TRANSCODE_CODEC}{bitrate}"
+
+def run_ffmpeg(source, target, bitrate, title, artist):
+    encoder, _, extra = TRANSCODE_CODECS[TRANSCODE_CODEC]
+    subprocess.run(
+        [FFMPEG_BINARY, '-nostdin', '-y', '-loglevel', 'error', '-i', source, '-vn', '-map_metadata', '-1',
+         '-metadata', f"title={title}", '-metadata', f"artist={artist}",
+         '-c:a', encoder, '-b:a', f"{bitrate}k", *extra, target],
+        check=True, capture_output=True, timeout=300
+    )
+
+async def transcode_audio(video_id, fmt, source, track):
+    cached = await audio_cache.get(video_id, fmt)
+    if cached:
+        return cached
+    bitrate = int(fmt[len(TRANSCODE_CODEC):])
+    staged_file = audio_cache.staging_path(video_id, fmt) + TRANSCODE_CODECS[TRANSCODE_CODEC][1]
+    try:
+        await transcode_pool.run(run_ffmpeg, source, staged_file, bitrate, track['title'], track['artist'])
+    except Exception:
+        if os.path.exists(staged_file):
+            os.remove(staged_file)
+        raise
+    return await audio_cache.commit(video_id, fmt, staged_file)
+
+async def prepare_audio(video_id, fmt, track):
+    # Returns the file to upload and the format it actually is in
+    if fmt != AUDIO_SOURCE_FORMAT:
+        cached = await audio_cache.get(video_id, fmt)
+        if cached:
+            return cached, fmt
+    source = await download_audio(video_id)
+    if not source or fmt == AUDIO_SOURCE_FORMAT:
+        return source, AUDIO_SOURCE_FORMAT
+    try:
+        key = f"{video_id}:{fmt}"
+        return await download_flights.run(key, functools.partial(transcode_audio, video_id, fmt, source, track)), fmt
+    except StageBusyError:
+        raise
     except Exception as e:
-        logger.error(f"Error downloading audio: {e}")
+        logger.error(f"Error transcoding {video_id} to {fmt}, sending source audio: {e}")
+        return source, AUDIO_SOURCE_FORMAT
+
+async def get_audio_file_id(video_id, fmt):
+    return await db.fetchval(
+        "SELECT file_id FROM audio_files WHERE video_id = ? AND format = ?", (video_id, fmt)
+    )
+
+async def save_audio_file_id(video_id, fmt, file_id, file_unique_id):
+    await db.execute(
+        "INSERT OR REPLACE INTO audio_files (video_id, format, file_id, file_unique_id, created_at) "
+        "VALUES (?, ?, ?, ?, ?)",
+        (video_id, fmt, file_id, file_unique_id, datetime.utcnow().isoformat())
+    )
+
+async def forget_audio_file_id(video_id, fmt):
+    await db.execute("DELETE FROM audio_files WHERE video_id = ? AND format = ?", (video_id, fmt))
+
+class Prefetcher:
+    def __init__(self, concurrency, budget_bytes, budget_window, max_age, queue_size):
+        self.concurrency = concurrency
+        self.budget_bytes = budget_bytes
+        self.budget_window = budget_window
+        self.max_age = max_age
+        self.queue_size = queue_size
+        self.pending = OrderedDict()
+        self.prefetched = OrderedDict()
+        self.wakeup = asyncio.Event()
+        self.active = 0
+        self.window_start = time.time()
+        self.window_bytes = 0
+        self.completed = 0
+        self.used = 0
+        self.skipped = 0
+        self.total_bytes = 0
+
+    def submit(self, video_id, fmt, track):
+        key = (video_id, fmt)
+        if key in self.prefetched:
+            return
+        self.pending[key] = (track, time.time())
+        self.pending.move_to_end(key)
+        while len(self.pending) > self.queue_size:
+            self.pending.popitem(last=False)
+        self.wakeup.set()
+
+    def has_budget(self):
+        if time.time() - self.window_start > self.budget_window:
+            self.window_start = time.time()
+            self.window_bytes = 0
+        return self.window_bytes < self.budget_bytes
+
+    def can_start(self):
+        # Only use spare capacity: any queued real play, or the last free download worker, stops new prefetches
+        return (
+            self.active < self.concurrency
+            and download_scheduler.depth == 0
+            and download_pool.waiting == 0
+            and download_pool.active < download_pool.workers - 1
+            and transcode_pool.waiting == 0
+            and self.has_budget()
+        )
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            while self.pending and self.can_start():
+                key, (track, queued_at) = self.pending.popitem(last=True)
+                if time.time() - queued_at > self.max_age:
+                    self.skipped += 1
+                    continue
+                self.active += 1
+                asyncio.create_task(self.fetch(key, track))
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=1)
+            except asyncio.TimeoutError:
+                pass
+
+    async def fetch(self, key, track):
+        video_id, fmt = key
+        try:
+            if await audio_cache.lookup(video_id, fmt) or await get_audio_file_id(video_id, fmt):
+                self.skipped += 1
+                return
+            path, actual_fmt = await prepare_audio(video_id, fmt, track)
+            if not path:
+                return
+            size = os.path.getsize(path)
+            self.window_bytes += size
+            self.total_bytes += size
+            self.completed += 1
+            self.prefetched[(video_id, actual_fmt)] = time.time()
+            while len(self.prefetched) > self.queue_size * 10:
+                self.prefetched.popitem(last=False)
+        except Exception as e:
+            logger.info(f"Prefetch of {video_id} failed: {e}")
+        finally:
+            self.active -= 1
+            self.wakeup.set()
+
+    def claim(self, video_id, fmt):
+        if self.prefetched.pop((video_id, fmt), None):
+            self.used += 1
+
+    def stats(self):
+        return {
+            'completed': self.completed,
+            'used': self.used,
+            'skipped': self.skipped,
+            'bytes': self.total_bytes,
+            'hit_rate': self.used / self.completed if self.completed else 0.0
+        }
+
+class PipelineStage:
+    def __init__(self, name, workers, queue_size):
+        self.name = name
+        self.workers = workers
+        self.queue = asyncio.Queue(queue_size)
+        self.tasks = []
+        self.active = 0
+        self.processed = 0
+        self.wait_avg = 0.0
+        self.service_avg = 0.0
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+
+    async def run(self, func, *args, **kwargs):
+        future = asyncio.get_running_loop().create_future()
+        # A full queue blocks the producer; the file is already downloaded, so it waits rather than being dropped
+        await self.queue.put((func, args, kwargs, future, time.monotonic()))
+        return await future
+
+    async def worker(self):
+        while True:
+            func, args, kwargs, future, queued_at = await self.queue.get()
+            started = time.monotonic()
+            self.wait_avg = self.wait_avg * 0.9 + (started - queued_at) * 0.1
+            self.active += 1
+            try:
+                if not future.done():
+                    future.set_result(await func(*args, **kwargs))
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self.active -= 1
+                self.processed += 1
+                self.service_avg = self.service_avg * 0.9 + (time.monotonic() - started) * 0.1
+                self.queue.task_done()
+
+    def stats(self):
+        return {
+            'queued': self.queue.qsize(),
+            'active': self.active,
+            'processed': self.processed,
+            'rejected': 0,
+            'wait_ms': self.wait_avg * 1000,
+            'service_ms': self.service_avg * 1000
+        }
+
+upload_stage = PipelineStage('upload', UPLOAD_WORKERS, UPLOAD_QUEUE_SIZE)
+
+class DownloadJob:
+    __slots__ = ('user_id', 'factory', 'future', 'started', 'queued_at')
+
+    def __init__(self, user_id, factory):
+        self.user_id = user_id
+        self.factory = factory
+        self.future = asyncio.get_running_loop().create_future()
+        self.started = False
+        self.queued_at = time.monotonic()
+
+class DownloadScheduler:
+    def __init__(self, workers, max_depth):
+        self.workers = workers
+        self.max_depth = max_depth
+        # Premium lane is always drained first; inside a lane users take turns
+        self.lanes = (OrderedDict(), OrderedDict())
+        self.depth = 0
+        self.running = 0
+        self.rejected = 0
+        self.processed = 0
+        self.wait_avg = 0.0
+        self.service_avg = 0.0
+
+    def submit(self, user_id, premium, factory):
+        if self.depth >= self.max_depth:
+            self.rejected += 1
+            raise StageBusyError("Очередь загрузок переполнена")
+        job = DownloadJob(user_id, factory)
+        lane = self.lanes[0 if premium else 1]
+        lane.setdefault(user_id, deque()).append(job)
+        self.depth += 1
+        self.dispatch()
+        return job
+
+    def pop(self):
+        for lane in self.lanes:
+            if lane:
+                user_id, jobs = next(iter(lane.items()))
+                job = jobs.popleft()
+                if jobs:
+                    lane.move_to_end(user_id)
+                else:
+                    del lane[user_id]
+                self.depth -= 1
+                return job
         return None
 
-def enable_bot():
-    cursor.execute("UPDATE bot_status SET is_disabled = FALSE, disabled_until = NULL WHERE id = 1")
-    conn.commit()
+    def order(self):
+        for lane in self.lanes:
+            queues = list(lane.values())
+            for row in range(max((len(jobs) for jobs in queues), default=0)):
+                for jobs in queues:
+                    if row < len(jobs):
+                        yield jobs[row]
+
+    def position(self, job):
+        for position, queued in enumerate(self.order(), start=1):
+            if queued is job:
+                return position
+        return 0
+
+    def dispatch(self):
+        while self.running < self.workers:
+            job = self.pop()
+            if job is None:
+                return
+            self.running += 1
+            job.started = True
+            self.wait_avg = self.wait_avg * 0.9 + (time.monotonic() - job.queued_at) * 0.1
+            asyncio.create_task(self.execute(job))
+
+    async def execute(self, job):
+        started = time.monotonic()
+        try:
+            result = await job.factory()
+            if not job.future.done():
+                job.future.set_result(result)
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        finally:
+            self.running -= 1
+            self.processed += 1
+            self.service_avg = self.service_avg * 0.9 + (time.monotonic() - started) * 0.1
+            self.dispatch()
+
+    def stats(self):
+        return {
+            'queued': self.depth,
+            'active': self.running,
+            'processed': self.processed,
+            'rejected': self.rejected,
+            'wait_ms': self.wait_avg * 1000,
+            'service_ms': self.service_avg * 1000
+        }
+
+download_scheduler = DownloadScheduler(DOWNLOAD_WORKERS, DOWNLOAD_MAX_QUEUE)
+
+async def wait_for_download(job, message):
+    status = None
+    shown = None
+    try:
+        while True:
+            done, _ = await asyncio.wait({job.future}, timeout=DOWNLOAD_STATUS_INTERVAL if status else 1)
+            if done:
+                return job.future.result()
+            position = download_scheduler.position(job)
+            if not position:
+                break
+            text = f"⏳ Вы в очереди на загрузку: позиция {position}"
+            if text == shown:
+                continue
+            try:
+                if status:
+                    await status.edit_text(text)
+                else:
+                    status = await message.answer(text)
+                shown = text
+            except TelegramBadRequest as e:
+                logger.warning(f"Failed to update download status: {e}")
+    finally:
+        if status:
+            try:
+                await status.delete()
+            except TelegramBadRequest:
+                pass
+    # the job is running now; asyncio.wait keeps a cancelled caller from cancelling the shared future
+    await asyncio.wait({job.future})
+    return job.future.result()
+
+prefetcher = Prefetcher(PREFETCH_CONCURRENCY, PREFETCH_BUDGET_BYTES, PREFETCH_BUDGET_WINDOW, PREFETCH_MAX_AGE,
+                        PREFETCH_QUEUE_SIZE)
+prefetcher_task = None
+
+class BotStatus:
+    def __init__(self, poll_interval):
+        self.poll_interval = poll_interval
+        self.disabled = False
+        self.disabled_until = None
+        self.deadline = None
+        self.timer = None
+        self.watch_conn = None
+
+    def is_disabled(self):
+        return self.disabled and (self.deadline is None or time.monotonic() < self.deadline)
+
+    def apply(self, is_disabled, disabled_until):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        self.disabled = bool(is_disabled)
+        self.disabled_until = disabled_until
+        self.deadline = None
+        if not self.disabled or not disabled_until:
+            return
+        try:
+            remaining = (datetime.fromisoformat(disabled_until) - datetime.utcnow()).total_seconds()
+        except ValueError:
+            self.disabled = False
+            return
+        self.deadline = time.monotonic() + remaining
+        self.timer = asyncio.get_running_loop().call_later(max(remaining, 0), self.expire)
+
+    def expire(self):
+        disabled_until = self.disabled_until
+        self.apply(False, None)
+        logger.info("Bot re-enabled after scheduled downtime")
+        # Only clear the row if nobody has set a new deadline in the meantime
+        asyncio.create_task(db.execute(
+            "UPDATE bot_status SET is_disabled = FALSE, disabled_until = NULL WHERE id = 1 AND disabled_until = ?",
+            (disabled_until,)
+        ))
+
+    async def load(self):
+        status = await db.fetchone("SELECT is_disabled, disabled_until FROM bot_status WHERE id = 1")
+        if status:
+            self.apply(*status)
+        else:
+            self.apply(False, None)
 
-def log_history(uid, item, source='youtube'):
-    if not all(key in item for key in ['title', 'artist', 'duration', 'video_id']):
-        logger.error("Invalid item format for history logging")
-        return
-    cursor.execute(
-        "INSERT INTO history VALUES (?, ?, ?, ?, ?, ?, ?)",
-        (uid, item['title'], item['artist'], item['duration'], item['video_id'], datetime.utcnow().isoformat(), source)
+    async def watch(self):
+        # data_version changes whenever another connection (or process) commits to the database
+        loop = asyncio.get_running_loop()
+        self.watch_conn = await loop.run_in_executor(db.read_executor, db.connect)
+        version = None
+        try:
+            while True:
+                try:
+                    current = (await loop.run_in_executor(
+                        db.read_executor, read_fetchone, self.watch_conn, "PRAGMA data_version", ()
+                    ))[0]
+                    if current != version:
+                        version = current
+                        await self.load()
+                except Exception as e:
+                    logger.error(f"Error checking bot status: {e}")
+                await asyncio.sleep(self.poll_interval)
+        finally:
+            self.watch_conn.close()
+
+bot_status = BotStatus(BOT_STATUS_POLL_INTERVAL)
+bot_status_task = None
+
+def is_bot_disabled():
+    return bot_status.is_disabled()
+
+async def enable_bot():
+    await db.execute("UPDATE bot_status SET is_disabled = FALSE, disabled_until = NULL WHERE id = 1")
+    bot_status.apply(False, None)
+
+async def disable_bot(minutes):
+    until = (datetime.utcnow() + timedelta(minutes=minutes)).isoformat()
+    await db.execute(
+        "UPDATE bot_status SET is_disabled = TRUE, disabled_until = ? WHERE id = 1",
+        (until,)
     )
+    bot_status.apply(True, until)
+
+def build_cooccurrence(rows):
+    index, items, baskets = {}, [], {}
+    for user_id, video_id in rows:
+        column = index.get(video_id)
+        if column is None:
+            column = index[video_id] = len(items)
+            items.append(video_id)
+        baskets.setdefault(user_id, set()).add(column)
+    popularity = [0] * len(items)
+    for basket in baskets.values():
+        for column in basket:
+            popularity[column] += 1
+    if sparse is None:
+        pending = {}
+        for basket in baskets.values():
+            for a in basket:
+                row = pending.setdefault(a, {})
+                for b in basket:
+                    if a != b:
+                        row[b] = row.get(b, 0) + 1
+        return index, items, baskets, popularity, None, pending
+    users = list(baskets)
+    columns = np.fromiter((column for user_id in users for column in baskets[user_id]), dtype=np.int64)
+    indptr = np.zeros(len(users) + 1, dtype=np.int64)
+    np.cumsum([len(baskets[user_id]) for user_id in users], out=indptr[1:])
+    incidence = sparse.csr_matrix(
+        (np.ones(len(columns), dtype=np.float32), columns, indptr), shape=(len(users), len(items))
+    )
+    # users x items incidence -> items x items co-occurrence counts
+    return index, items, baskets, popularity, (incidence.T @ incidence).tocsr(), {}
+
+def grow_matrix(matrix, size):
+    extra = size - matrix.shape[0]
+    if extra <= 0:
+        return matrix
+    indptr = np.concatenate([matrix.indptr, np.full(extra, matrix.indptr[-1], dtype=matrix.indptr.dtype)])
+    return sparse.csr_matrix((matrix.data, matrix.indices, indptr), shape=(size, size))
+
+class Recommender:
+    def __init__(self, compact_threshold, candidates):
+        self.compact_threshold = compact_threshold
+        self.candidates = candidates
+        self.index = {}
+        self.items = []
+        self.baskets = {}
+        self.popularity = []
+        # Compacted co-occurrence counts (scipy) plus increments not yet folded in;
+        # without scipy the increments dict is the whole matrix
+        self.matrix = None
+        self.pending = {}
+        self.pending_count = 0
+        self.ready = False
+        self.backlog = None
+
+    def column(self, video_id):
+        column = self.index.get(video_id)
+        if column is None:
+            column = self.index[video_id] = len(self.items)
+            self.items.append(video_id)
+            self.popularity.append(0)
+        return column
+
+    def bump(self, a, b, delta=1):
+        row = self.pending.setdefault(a, {})
+        count = row.get(b, 0) + delta
+        if count:
+            row[b] = count
+        else:
+            del row[b]
+        self.pending_count += 1
+
+    def add(self, user_id, video_id):
+        if self.backlog is not None:
+            self.backlog.append((self.add, user_id, video_id))
+            return
+        column = self.column(video_id)
+        basket = self.baskets.setdefault(user_id, set())
+        if column in basket:
+            return
+        for other in basket:
+            self.bump(column, other)
+            self.bump(other, column)
+        basket.add(column)
+        self.popularity[column] += 1
+        if sparse is not None and self.pending_count >= self.compact_threshold:
+            self.compact()
+
+    def remove(self, user_id, video_id):
+        # The history ring overwrote the track and it is not a favorite either
+        if self.backlog is not None:
+            self.backlog.append((self.remove, user_id, video_id))
+            return
+        column = self.index.get(video_id)
+        basket = self.baskets.get(user_id)
+        if column is None or not basket or column not in basket:
+            return
+        basket.remove(column)
+        self.popularity[column] -= 1
+        for other in basket:
+            self.bump(column, other, -1)
+            self.bump(other, column, -1)
+        if sparse is not None and self.pending_count >= self.compact_threshold:
+            self.compact()
+
+    def compact(self):
+        size = len(self.items)
+        rows, columns, counts = [], [], []
+        for a, row in self.pending.items():
+            for b, count in row.items():
+                rows.append(a)
+                columns.append(b)
+                counts.append(count)
+        delta = sparse.csr_matrix((counts, (rows, columns)), shape=(size, size), dtype=np.float32)
+        self.matrix = delta if self.matrix is None else grow_matrix(self.matrix, size) + delta
+        self.matrix.eliminate_zeros()
+        self.pending = {}
+        self.pending_count = 0
+
+    async def rebuild(self):
+        self.backlog = []
+        try:
+            rows = await db.fetchall(
+                "SELECT user_id, video_id FROM history WHERE video_id IS NOT NULL "
+                "UNION SELECT user_id, video_id FROM favorites WHERE video_id IS NOT NULL"
+            )
+            state = await asyncio.get_running_loop().run_in_executor(None, build_cooccurrence, rows)
+            self.index, self.items, self.baskets, self.popularity, self.matrix, self.pending = state
+            self.pending_count = 0
+        except Exception as e:
+            logger.error(f"Error building recommender, continuing with incremental updates only: {e}")
+        finally:
+            backlog, self.backlog = self.backlog, None
+        for method, user_id, video_id in backlog:
+            method(user_id, video_id)
+        self.ready = True
+        logger.info(f"Recommender built: {len(self.items)} tracks, {len(self.baskets)} users")
+
+    def scores(self, basket):
+        if sparse is None:
+            totals = {}
+            for a in basket:
+                for b, count in self.pending.get(a, {}).items():
+                    totals[b] = totals.get(b, 0) + count
+            return totals.items()
+        totals = np.zeros(len(self.items), dtype=np.float32)
+        if self.matrix is not None:
+            rows = [row for row in basket if row < self.matrix.shape[0]]
+            if rows:
+                totals[:self.matrix.shape[0]] = np.asarray(self.matrix[rows].sum(axis=0)).ravel()
+        for a in basket:
+            for b, count in self.pending.get(a, {}).items():
+                totals[b] += count
+        totals[list(basket)] = 0
+        count = min(self.candidates, len(totals))
+        top = np.argpartition(-totals, count - 1)[:count]
+        return [(int(column), float(totals[column])) for column in top]
+
+    def recommend(self, user_id, limit):
+        basket = self.baskets.get(user_id)
+        if not self.ready or not basket:
+            return []
+        # Damp raw co-occurrence by popularity so hits every user has don't dominate
+        ranked = sorted(
+            ((score / self.popularity[column] ** 0.5, column)
+             for column, score in self.scores(basket) if score > 0 and column not in basket),
+            reverse=True
+        )
+        return [self.items[column] for _, column in ranked[:limit]]
+
+recommender = Recommender(RECOMMENDER_COMPACT_THRESHOLD, RECOMMENDER_CANDIDATES)
+recommender_task = None
+
+async def rebuild_recommender_periodically():
+    # Incremental updates only cover this worker's plays; a rebuild from the shared tables picks up the others'
+    while True:
+        await recommender.rebuild()
+        await asyncio.sleep(RECOMMENDER_REBUILD_INTERVAL)
+
+def write_history(cursor, uid, item, created_at, source):
+    # Upsert into the next ring slot instead of insert + trim; returns a track that left the user's history
+    next_seq = cursor.execute("SELECT COALESCE(MAX(seq) + 1, 0) FROM history WHERE user_id = ?", (uid,)).fetchone()[0]
+    slot = next_seq % HISTORY_LIMIT
+    overwritten = cursor.execute(
+        "SELECT video_id FROM history WHERE user_id = ? AND slot = ?", (uid, slot)
+    ).fetchone()
     cursor.execute(
         """
-        DELETE FROM history
-        WHERE user_id = ? AND rowid NOT IN
-        (SELECT rowid FROM history WHERE user_id = ? ORDER BY datetime(created_at) DESC LIMIT 50)
-        """, (uid, uid))
-    conn.commit()
+        INSERT INTO history (user_id, title, artist, duration, video_id, created_at, source, seq, slot)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, slot) DO UPDATE SET
+            title = excluded.title,
+            artist = excluded.artist,
+            duration = excluded.duration,
+            video_id = excluded.video_id,
+            created_at = excluded.created_at,
+            source = excluded.source,
+            seq = excluded.seq
+        """,
+        (uid, item['title'], item['artist'], item['duration'], item['video_id'], created_at, source, next_seq, slot)
+    )
+    if not overwritten or overwritten[0] is None:
+        return None
+    still_known = cursor.execute(
+        "SELECT EXISTS (SELECT 1 FROM history WHERE user_id = ? AND video_id = ?) "
+        "OR EXISTS (SELECT 1 FROM favorites WHERE user_id = ? AND video_id = ?)",
+        (uid, overwritten[0], uid, overwritten[0])
+    ).fetchone()[0]
+    return None if still_known else overwritten[0]
+
+async def log_history(uid, item, source='youtube'):
+    if not all(key in item for key in ['title', 'artist', 'duration', 'video_id']):
+        logger.error("Invalid item format for history logging")
+        return
+    evicted = await db.transaction(write_history, uid, item, datetime.utcnow().isoformat(), source)
+    recommender.add(uid, item['video_id'])
+    if evicted:
+        recommender.remove(uid, evicted)
 
 def is_admin(uid):
     return uid in ADMIN_IDS
 
-def is_bot_disabled():
-    cursor.execute("SELECT is_disabled, disabled_until FROM bot_status WHERE id = 1")
-    status = cursor.fetchone()
-    if not status:
-        return False
-    is_disabled, disabled_until = status
-    if is_disabled and disabled_until:
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_slot = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = time.monotonic()
+            if self.next_slot > now:
+                await asyncio.sleep(self.next_slot - now)
+                now = self.next_slot
+            self.next_slot = now + self.interval
+
+    def pause(self, seconds):
+        self.next_slot = max(self.next_slot, time.monotonic() + seconds)
+
+broadcast_limiter = RateLimiter(BROADCAST_RATE)
+broadcast_tasks = {}
+
+BROADCAST_FIELDS = ('id', 'admin_id', 'text', 'photo_path', 'video_path', 'media_file_id', 'button_title',
+                    'button_url', 'status', 'last_user_id', 'sent', 'failed', 'progress_message_id')
+
+async def get_broadcast(job_id):
+    row = await db.fetchone(f"SELECT {', '.join(BROADCAST_FIELDS)} FROM broadcasts WHERE id = ?", (job_id,))
+    return dict(zip(BROADCAST_FIELDS, row)) if row else None
+
+async def claim_broadcast(job_id):
+    now = time.time()
+    result = await db.execute(
+        """
+        UPDATE broadcasts SET owner = ?, lease_until = ?
+        WHERE id = ? AND status = 'running' AND (owner IS NULL OR owner = ? OR lease_until < ?)
+        """,
+        (WORKER_ID, now + BROADCAST_LEASE_SECONDS, job_id, WORKER_ID, now)
+    )
+    return result.rowcount == 1
+
+async def save_broadcast_progress(job):
+    # Also renews the lease; False means another worker has taken the broadcast over
+    result = await db.execute(
+        """
+        UPDATE broadcasts SET last_user_id = ?, sent = ?, failed = ?, media_file_id = ?, lease_until = ?
+        WHERE id = ? AND owner = ?
+        """,
+        (job['last_user_id'], job['sent'], job['failed'], job['media_file_id'], time.time() + BROADCAST_LEASE_SECONDS,
+         job['id'], WORKER_ID)
+    )
+    return result.rowcount == 1
+
+async def start_broadcast(admin_id, message_text, photo_path=None, video_path=None, button_title=None, button_url=None):
+    result = await db.execute(
+        """
+        INSERT INTO broadcasts (admin_id, text, photo_path, video_path, button_title, button_url, created_at, owner,
+                                lease_until)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (admin_id, message_text, photo_path, video_path, button_title, button_url, datetime.utcnow().isoformat(),
+         WORKER_ID, time.time() + BROADCAST_LEASE_SECONDS)
+    )
+    job_id = result.lastrowid
+    progress = await bot.send_message(admin_id, f"📢 Рассылка #{job_id} запускается...")
+    await db.execute("UPDATE broadcasts SET progress_message_id = ? WHERE id = ?", (progress.message_id, job_id))
+    resume_broadcast(job_id)
+    return job_id
+
+def resume_broadcast(job_id):
+    if job_id in broadcast_tasks:
+        return
+    task = asyncio.create_task(run_broadcast(job_id))
+    broadcast_tasks[job_id] = task
+    task.add_done_callback(lambda t: broadcast_tasks.pop(job_id, None))
+
+async def watch_broadcasts():
+    # Picks up running broadcasts whose owner stopped renewing, e.g. a worker that crashed or was restarted
+    while True:
+        try:
+            rows = await db.fetchall(
+                "SELECT id FROM broadcasts WHERE status = 'running' AND (owner IS NULL OR lease_until < ?)",
+                (time.time(),)
+            )
+            for (job_id,) in rows:
+                resume_broadcast(job_id)
+        except Exception as e:
+            logger.error(f"Error checking broadcasts: {e}")
+        await asyncio.sleep(BROADCAST_LEASE_SECONDS / 2)
+
+async def release_broadcasts():
+    for task in list(broadcast_tasks.values()):
+        task.cancel()
+    await asyncio.gather(*broadcast_tasks.values(), return_exceptions=True)
+    await db.execute("UPDATE broadcasts SET lease_until = 0 WHERE owner = ? AND status = 'running'", (WORKER_ID,))
+
+broadcast_watch_task = None
+
+async def deliver_broadcast(job, user_id, markup):
+    for attempt in range(BROADCAST_MAX_RETRIES):
+        await broadcast_limiter.wait()
         try:
-            if datetime.fromisoformat(disabled_until) > datetime.utcnow():
-                return True
+            if job['photo_path']:
+                photo = job['media_file_id'] or FSInputFile(job['photo_path'])
+                sent = await bot.send_photo(user_id, photo, caption=job['text'], parse_mode='HTML', reply_markup=markup)
+                if not job['media_file_id']:
+                    job['media_file_id'] = sent.photo[-1].file_id
+            elif job['video_path']:
+                video = job['media_file_id'] or FSInputFile(job['video_path'])
+                sent = await bot.send_video(user_id, video, caption=job['text'], parse_mode='HTML', reply_markup=markup)
+                if not job['media_file_id']:
+                    job['media_file_id'] = sent.video.file_id
             else:
-                enable_bot()
-                return False
-        except ValueError:
+                await bot.send_message(user_id, job['text'], parse_mode='HTML', reply_markup=markup)
+            return True
+        except TelegramRetryAfter as e:
+            logger.warning(f"Broadcast #{job['id']} hit flood control, pausing for {e.retry_after}s")
+            broadcast_limiter.pause(e.retry_after)
+        except Exception as e:
+            logger.error(f"Failed to send message to {user_id}: {e}")
             return False
-    return is_disabled
+    return False
 
-def disable_bot(minutes):
-    until = datetime.utcnow() + timedelta(minutes=minutes)
-    cursor.execute(
-        "UPDATE bot_status SET is_disabled = TRUE, disabled_until = ? WHERE id = 1",
-        (until.isoformat(),)
+async def report_broadcast_progress(job, total, finished=False):
+    header = "✅ Рассылка завершена" if finished else "📢 Идёт рассылка"
+    text = (
+        f"{header} #{job['id']}\n"
+        f"📨 Отправлено: <b>{job['sent']}</b>\n"
+        f"⚠️ Ошибок: <b>{job['failed']}</b>\n"
+        f"👥 Обработано: <b>{job['sent'] + job['failed']}</b> из <b>{total}</b>"
     )
-    conn.commit()
+    try:
+        await bot.edit_message_text(text, chat_id=job['admin_id'], message_id=job['progress_message_id'],
+                                    parse_mode='HTML')
+    except Exception as e:
+        logger.warning(f"Failed to update broadcast #{job['id']} progress: {e}")
 
-async def broadcast_message(message_text, users=None, photo_path=None, video_path=None, button_title=None, button_url=None):
-    if users is None:
-        cursor.execute("SELECT id FROM users")
-        users = [row[0] for row in cursor.fetchall()]
-    count = 0
+async def run_broadcast(job_id):
+    if not await claim_broadcast(job_id):
+        return
+    job = await get_broadcast(job_id)
+    if not job or job['status'] != 'running':
+        return
     kb = None
-    if button_title and button_url:
+    if job['button_title'] and job['button_url']:
         kb = InlineKeyboardBuilder()
-        kb.add(InlineKeyboardButton(text=button_title, url=button_url))
-    for user_id in users:
-        try:
-            if photo_path:
-                photo = FSInputFile(photo_path)
-                await bot.send_photo(user_id, photo, caption=message_text, parse_mode='HTML',
-                                    reply_markup=kb.as_markup() if kb else None)
-            elif video_path:
-                video = FSInputFile(video_path)
-                await bot.send_video(user_id, video, caption=message_text, parse_mode='HTML',
-                                    reply_markup=kb.as_markup() if kb else None)
-            else:
-                await bot.send_message(user_id, message_text, parse_mode='HTML',
-                                      reply_markup=kb.as_markup() if kb else None)
-            count += 1
-            await asyncio.sleep(0.05)
-        except Exception as e:
-            logger.error(f"Failed to send message to {user_id}: {e}")
-    return count
+        kb.add(InlineKeyboardButton(text=job['button_title'], url=job['button_url']))
+    markup = kb.as_markup() if kb else None
+    needs_upload = bool(job['photo_path'] or job['video_path'])
+    total = await db.fetchval("SELECT COUNT(*) FROM users")
+    last_report = 0.0
+
+    logger.info(f"Broadcast #{job_id} running from user id {job['last_user_id']}")
+    while True:
+        rows = await db.fetchall(
+            "SELECT id FROM users WHERE id > ? ORDER BY id LIMIT ?",
+            (job['last_user_id'], BROADCAST_BATCH_SIZE)
+        )
+        batch = [row[0] for row in rows]
+        if not batch:
+            break
+        # Upload the media once, then everyone else gets it by file_id
+        while needs_upload and not job['media_file_id'] and batch:
+            user_id = batch.pop(0)
+            ok = await deliver_broadcast(job, user_id, markup)
+            job['sent' if ok else 'failed'] += 1
+            job['last_user_id'] = user_id
+            if not await save_broadcast_progress(job):
+                logger.warning(f"Broadcast #{job_id} was taken over by another worker")
+                return
+        # The cursor is saved after every chunk, so a restart re-sends at most BROADCAST_CONCURRENCY messages
+        for start in range(0, len(batch), BROADCAST_CONCURRENCY):
+            chunk = batch[start:start + BROADCAST_CONCURRENCY]
+            results = await asyncio.gather(*(deliver_broadcast(job, user_id, markup) for user_id in chunk))
+            job['sent'] += sum(1 for ok in results if ok)
+            job['failed'] += sum(1 for ok in results if not ok)
+            job['last_user_id'] = chunk[-1]
+            if not await save_broadcast_progress(job):
+                logger.warning(f"Broadcast #{job_id} was taken over by another worker")
+                return
+        if time.monotonic() - last_report >= BROADCAST_PROGRESS_INTERVAL:
+            last_report = time.monotonic()
+            await report_broadcast_progress(job, total)
+
+    await db.execute(
+        "UPDATE broadcasts SET status = 'completed', finished_at = ? WHERE id = ?",
+        (datetime.utcnow().isoformat(), job_id)
+    )
+    for path in (job['photo_path'], job['video_path']):
+        if path and os.path.exists(path):
+            os.remove(path)
+    await report_broadcast_progress(job, total, finished=True)
+    logger.info(f"Broadcast #{job_id} finished: {job['sent']} sent, {job['failed']} failed")
 
 async def get_bot_stats():
-    cursor.execute("SELECT COUNT(*) FROM users")
-    total_users = cursor.fetchone()[0]
-    cursor.execute("SELECT COUNT(*) FROM users WHERE premium_until > ?", (datetime.utcnow().isoformat(),))
-    premium_users = cursor.fetchone()[0]
-    cursor.execute("SELECT COUNT(*) FROM history")
-    total_downloads = cursor.fetchone()[0]
-    cursor.execute("SELECT COUNT(*) FROM users WHERE referrals > 0")
-    users_with_referrals = cursor.fetchone()[0]
-    cursor.execute("SELECT COUNT(*) FROM payments WHERE status = 'pending'")
-    pending_payments = cursor.fetchone()[0]
+    total_users = await db.fetchval("SELECT COUNT(*) FROM users")
+    premium_users = await db.fetchval("SELECT COUNT(*) FROM users WHERE premium_until > ?",
+                                      (datetime.utcnow().isoformat(),))
+    total_downloads = await db.fetchval("SELECT COUNT(*) FROM history")
+    users_with_referrals = await db.fetchval("SELECT COUNT(*) FROM users WHERE referrals > 0")
+    pending_payments = await db.fetchval("SELECT COUNT(*) FROM payments WHERE status = 'pending'")
     return {
         'total_users': total_users,
         'premium_users': premium_users,
         'total_downloads': total_downloads,
         'users_with_referrals': users_with_referrals,
-        'pending_payments': pending_payments
+        'pending_payments': pending_payments,
+        'audio_cache': await audio_cache.stats(),
+        'downloads': dict(download_stats),
+        'loop_lag': loop_lag_monitor.stats(),
+        'subscriptions': await subscription_cache.stats(),
+        'prefetch': prefetcher.stats(),
+        'stages': {
+            'download': download_scheduler.stats(),
+            'upload': upload_stage.stats()
+        }
     }
 
 def get_premium_price(days, is_new_user=False):
@@ -413,52 +2260,49 @@ def get_premium_price(days, is_new_user=False):
         return int(base_price * (1 - NEW_USER_DISCOUNT))
     return base_price
 
-def update_referral_balance(referrer_id, referral_id, amount):
+async def update_referral_balance(referrer_id, referral_id, amount):
     if referrer_id:
         percent_bonus = int(amount * 0.05)
-        premium_bonus = 50 if get_user_field(referral_id, 'premium_until') else 0
+        referral = await load_user(referral_id)
+        premium_bonus = 50 if referral and referral.premium_until else 0
         total_bonus = percent_bonus + premium_bonus
         if total_bonus > 0:
-            current_balance = get_user_field(referrer_id, 'balance') or 0
-            update_user(referrer_id, balance=current_balance + total_bonus)
-            cursor.execute("UPDATE users SET referrals = referrals + 1 WHERE id = ?", (referrer_id,))
-            conn.commit()
+            await db.execute(
+                "UPDATE users SET balance = balance + ?, referrals = referrals + 1 WHERE id = ?",
+                (total_bonus, referrer_id)
+            )
 
-def create_payment(user_id, amount, days):
+async def create_payment(user_id, amount, days):
     created_at = datetime.utcnow().isoformat()
-    cursor.execute(
+    result = await db.execute(
         "INSERT INTO payments (user_id, amount, days, created_at) VALUES (?, ?, ?, ?)",
         (user_id, amount, days, created_at)
     )
-    conn.commit()
-    return cursor.lastrowid
+    return result.lastrowid
 
-def get_payment(payment_id):
-    cursor.execute("SELECT * FROM payments WHERE id = ?", (payment_id,))
-    return cursor.fetchone()
+async def get_payment(payment_id):
+    return await db.fetchone("SELECT * FROM payments WHERE id = ?", (payment_id,))
 
-def update_payment(payment_id, status, screenshot=None):
+async def update_payment(payment_id, status, screenshot=None):
     processed_at = datetime.utcnow().isoformat()
     if screenshot:
-        cursor.execute(
+        await db.execute(
             "UPDATE payments SET status = ?, processed_at = ?, screenshot = ? WHERE id = ?",
             (status, processed_at, screenshot, payment_id)
         )
     else:
-        cursor.execute(
+        await db.execute(
             "UPDATE payments SET status = ?, processed_at = ? WHERE id = ?",
             (status, processed_at, payment_id)
         )
-    conn.commit()
 
 @dp.message(Command("start"))
-async def cmd_start(message: types.Message):
+async def cmd_start(message: types.Message, user: UserRecord):
     if is_bot_disabled():
         await message.answer("⚠️ Бот временно отключен. Попробуйте позже.")
         return
 
-    uid = message.from_user.id
-    get_user(uid)
+    uid = user.id
 
     if not await check_subscription(uid):
         kb = InlineKeyboardBuilder()
@@ -484,9 +2328,9 @@ async def cmd_start(message: types.Message):
                 except ValueError:
                     pass
 
-    if referral_id and get_user_field(uid, 'is_new_user'):
-        update_user(uid, referrer_id=referral_id)
-        update_user(referral_id, referrals=get_user_field(referral_id, 'referrals') + 1)
+    if referral_id and get_user_field(user, 'is_new_user'):
+        user.set(referrer_id=referral_id)
+        await db.execute("UPDATE users SET referrals = referrals + 1 WHERE id = ?", (referral_id,))
         await bot.send_message(
             referral_id,
             f"🎉 Новый реферал! Пользователь {uid} присоединился по вашей ссылке. "
@@ -515,11 +2359,11 @@ async def cmd_start(message: types.Message):
 
     💡 *Мы в SoundPlus помогаем быстро находить и слушать любимую музыку без лишних хлопот!*
     """
-    is_new_user = get_user_field(uid, 'is_new_user')
-    if has_premium(uid):
+    is_new_user = get_user_field(user, 'is_new_user')
+    if has_premium(user):
         await message.answer("Привет! Премиум тариф активен 🎵", reply_markup=kb.as_markup())
     else:
-        total_downloads = get_user_field(uid, 'total_downloads') or 0
+        total_downloads = counter_store.total_downloads(uid)
         discount_msg = "\n✨ Новым пользователям: первый месяц премиума со скидкой 20%!" if is_new_user else ""
         welcome_message += f"\n📢 Бесплатный тариф: осталось {30 - total_downloads} треков из 30."
         await message.answer(
@@ -539,19 +2383,18 @@ async def cmd_start(message: types.Message):
         await message.answer(welcome_message, reply_markup=kb.as_markup(), parse_mode="Markdown")
 
 @dp.callback_query(F.data == "profile")
-async def profile(cb: types.CallbackQuery):
+async def profile(cb: types.CallbackQuery, user: UserRecord):
     if is_bot_disabled():
         await cb.message.answer("⚠️ Бот временно отключен. Попробуйте позже.")
         return
-    user_id = cb.from_user.id
-    get_user(user_id)
+    user_id = user.id
     increment_action_count(user_id)
 
-    balance = get_user_field(user_id, 'balance') or 0
-    referrals = get_user_field(user_id, 'referrals') or 0
-    lang = get_user_field(user_id, 'lang') or 'Русский'
-    premium_until = get_user_field(user_id, 'premium_until')
-    referrer_id = get_user_field(user_id, 'referrer_id')
+    balance = get_user_field(user, 'balance') or 0
+    referrals = get_user_field(user, 'referrals') or 0
+    lang = get_user_field(user, 'lang') or 'Русский'
+    premium_until = get_user_field(user, 'premium_until')
+    referrer_id = get_user_field(user, 'referrer_id')
 
     text = (
         f"👤 <b>Профиль</b>\n"
@@ -559,7 +2402,7 @@ async def profile(cb: types.CallbackQuery):
         f"💰 Баланс: <b>{balance}₽</b>\n"
         f"👥 Рефералы: <b>{referrals}</b>\n"
         f"🌐 Язык: <b>{lang}</b>\n"
-        f"💎 Premium: <b>{'✅ Активен' if has_premium(user_id) else '❌ Нет'}</b>\n"
+        f"💎 Premium: <b>{'✅ Активен' if has_premium(user) else '❌ Нет'}</b>\n"
         f"📌 Ваша ссылка:\n"
         f"<code>https://t.me/SoundPlus_bot?start=ref={user_id}</code>\n\n"
         f"📢 Дайте друзьям эту ссылку, и вы оба получите вознаграждение!"
@@ -568,7 +2411,7 @@ async def profile(cb: types.CallbackQuery):
     if referrer_id:
         text += f"👤 Пригласил вас: <code>{referrer_id}</code>\n"
 
-    if has_premium(user_id) and premium_until:
+    if has_premium(user) and premium_until:
         until_date = datetime.fromisoformat(premium_until).strftime('%d.%m.%Y')
         text += f"⏳ Подписка до: <b>{until_date}</b>\n"
 
@@ -588,19 +2431,18 @@ async def profile(cb: types.CallbackQuery):
     await cb.message.answer(text, reply_markup=inline_kb.as_markup(), parse_mode="HTML")
     await cb.message.answer("Выберите действие:", reply_markup=reply_kb.as_markup(resize_keyboard=True))
 
-    if should_send_ad(user_id):
+    if should_send_ad(user):
         await cb.message.answer(send_ad_text())
         reset_action_count(user_id)
 
 @dp.callback_query(F.data == "buy")
-async def buy(cb: types.CallbackQuery):
+async def buy(cb: types.CallbackQuery, user: UserRecord):
     if is_bot_disabled():
         await cb.message.answer("⚠️ Бот временно отключен. Попробуйте позже.")
         return
-    uid = cb.from_user.id
-    get_user(uid)
+    uid = user.id
     increment_action_count(uid)
-    is_new_user = get_user_field(uid, 'is_new_user')
+    is_new_user = get_user_field(user, 'is_new_user')
 
     kb = InlineKeyboardBuilder()
     for k in PREMIUM_DAYS:
@@ -613,7 +2455,7 @@ async def buy(cb: types.CallbackQuery):
     kb.adjust(1)
     await cb.message.answer("Выберите срок премиума:", reply_markup=kb.as_markup())
 
-    if should_send_ad(uid):
+    if should_send_ad(user):
         await cb.message.answer(send_ad_text())
         reset_action_count(uid)
 
@@ -638,34 +2480,96 @@ async def admin_panel(cb: types.CallbackQuery):
     await cb.message.answer("🛠 Админ-панель:", reply_markup=kb.as_markup())
 
 @dp.callback_query(F.data == "check_sub_start")
-async def check_subscription_start(cb: types.CallbackQuery):
+async def check_subscription_start(cb: types.CallbackQuery, user: UserRecord):
     uid = cb.from_user.id
+    await subscription_cache.invalidate(uid)
     if not await check_subscription(uid):
         await cb.answer("❌ Вы все еще не подписаны на канал", show_alert=True)
         return
     await cb.message.delete()
-    await cmd_start(cb.message)
+    await cmd_start(cb.message, user)
 
-async def check_subscription(user_id: int) -> bool:
-    try:
+SUBSCRIBED_STATUSES = ('member', 'administrator', 'creator')
+
+class SubscriptionCache:
+    # Kept in the shared database: an invalidation or channel update seen by one worker applies to all of them
+    def __init__(self, positive_ttl, negative_ttl):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, user_id):
+        row = await db.fetchone("SELECT subscribed, checked_at FROM subscriptions WHERE user_id = ?", (user_id,))
+        if not row:
+            return None
+        subscribed, checked_at = bool(row[0]), row[1]
+        ttl = self.positive_ttl if subscribed else self.negative_ttl
+        if time.time() - checked_at > ttl:
+            return None
+        return subscribed
+
+    async def put(self, user_id, subscribed, checked_at=None):
+        checked_at = checked_at or time.time()
+        # A lookup that started before a newer update must not overwrite it
+        await db.execute(
+            """
+            INSERT INTO subscriptions (user_id, subscribed, checked_at) VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET subscribed = excluded.subscribed, checked_at = excluded.checked_at
+            WHERE excluded.checked_at >= subscriptions.checked_at
+            """,
+            (user_id, int(subscribed), checked_at)
+        )
+
+    async def invalidate(self, user_id):
+        await db.execute("DELETE FROM subscriptions WHERE user_id = ?", (user_id,))
+
+    async def purge(self):
+        await db.execute("DELETE FROM subscriptions WHERE checked_at < ?",
+                         (time.time() - max(self.positive_ttl, self.negative_ttl),))
+
+    async def stats(self):
+        entries = await db.fetchval("SELECT COUNT(*) FROM subscriptions")
+        return {'entries': entries, 'hits': self.hits, 'misses': self.misses}
+
+subscription_cache = SubscriptionCache(SUBSCRIPTION_POSITIVE_TTL, SUBSCRIPTION_NEGATIVE_TTL)
+subscription_flights = SingleFlight()
+
+async def fetch_subscription(user_id):
+    started = time.time()
+    for chat_id in (CHANNEL_ID, CHANNEL_USERNAME):
         try:
-            chat_member = await bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-            return chat_member.status in ['member', 'administrator', 'creator']
+            chat_member = await bot.get_chat_member(chat_id=chat_id, user_id=user_id)
         except Exception as e:
-            logger.warning(f"Error checking subscription by ID: {e}")
-            try:
-                chat_member = await bot.get_chat_member(chat_id=CHANNEL_USERNAME, user_id=user_id)
-                return chat_member.status in ['member', 'administrator', 'creator']
-            except Exception as e:
-                logger.warning(f"Error checking subscription by username: {e}")
-                return False
+            logger.warning(f"Error checking subscription via {chat_id}: {e}")
+            continue
+        subscribed = chat_member.status in SUBSCRIBED_STATUSES
+        await subscription_cache.put(user_id, subscribed, started)
+        return subscribed
+    # API failures are not cached so the next action retries
+    return False
+
+async def check_subscription(user_id: int) -> bool:
+    subscribed = await subscription_cache.get(user_id)
+    if subscribed is not None:
+        subscription_cache.hits += 1
+        return subscribed
+    subscription_cache.misses += 1
+    try:
+        return await subscription_flights.run(user_id, lambda: fetch_subscription(user_id))
     except Exception as e:
         logger.error(f"Fatal error in check_subscription: {e}")
         return False
 
+@dp.chat_member(F.chat.id == CHANNEL_ID)
+async def on_channel_member_update(event: types.ChatMemberUpdated):
+    # Delivered only when the bot is a channel admin; keeps the cache fresh without API calls
+    member = event.new_chat_member
+    await subscription_cache.put(member.user.id, member.status in SUBSCRIBED_STATUSES)
+
 @dp.message(F.text.in_({"🔍 Поиск музыки", "🆕 Новинки", "🏆 Топ песен", "🌊 Моя волна"}))
-async def check_subscription_wrapper(message: types.Message, state: FSMContext):
-    uid = message.from_user.id
+async def check_subscription_wrapper(message: types.Message, state: FSMContext, user: UserRecord):
+    uid = user.id
     if not await check_subscription(uid):
         kb = InlineKeyboardBuilder()
         kb.add(InlineKeyboardButton(text="📢 Подписаться на канал", url=f"https://t.me/{CHANNEL_USERNAME[1:]}"))
@@ -677,49 +2581,49 @@ async def check_subscription_wrapper(message: types.Message, state: FSMContext):
         return
     increment_action_count(uid)
     if message.text == "🔍 Поиск музыки":
-        await cmd_search(message, state)
+        await cmd_search(message, state, user)
     elif message.text == "🆕 Новинки":
-        await cmd_new_releases(message, state)
+        await cmd_new_releases(message, state, user)
     elif message.text == "🏆 Топ песен":
-        await cmd_top_songs(message, state)
+        await cmd_top_songs(message, state, user)
     elif message.text == "🌊 Моя волна":
-        await cmd_my_wave(message, state)
-    if should_send_ad(uid):
+        await cmd_my_wave(message, state, user)
+    if should_send_ad(user):
         await message.answer(send_ad_text())
         reset_action_count(uid)
 
 @dp.callback_query(lambda c: c.data.startswith("check_sub_"))
-async def check_subscription_other(cb: types.CallbackQuery, state: FSMContext):
-    uid = cb.from_user.id
+async def check_subscription_other(cb: types.CallbackQuery, state: FSMContext, user: UserRecord):
+    uid = user.id
+    await subscription_cache.invalidate(uid)
     if not await check_subscription(uid):
         await cb.answer("❌ Вы все еще не подписаны на канал", show_alert=True)
         return
     command = cb.data.split("_", 2)[-1]
     increment_action_count(uid)
     if command == "🔍 Поиск музыки":
-        await cmd_search(cb.message, state)
+        await cmd_search(cb.message, state, user)
     elif command == "🆕 Новинки":
-        await cmd_new_releases(cb.message, state)
+        await cmd_new_releases(cb.message, state, user)
     elif command == "🏆 Топ песен":
-        await cmd_top_songs(cb.message, state)
+        await cmd_top_songs(cb.message, state, user)
     elif command == "🌊 Моя волна":
-        await cmd_my_wave(cb.message, state)
+        await cmd_my_wave(cb.message, state, user)
     await cb.message.delete()
-    if should_send_ad(uid):
+    if should_send_ad(user):
         await cb.message.answer(send_ad_text())
         reset_action_count(uid)
 
 @dp.callback_query(lambda c: c.data.startswith("prem_"))
-async def buy_premium(cb: types.CallbackQuery, state: FSMContext):
+async def buy_premium(cb: types.CallbackQuery, state: FSMContext, user: UserRecord):
     if is_bot_disabled():
         await cb.message.answer("⚠️ Бот временно отключен. Попробуйте позже.")
         return
     try:
         days = int(cb.data.split('_')[1])
-        uid = cb.from_user.id
-        get_user(uid)
+        uid = user.id
         increment_action_count(uid)
-        is_new_user = get_user_field(uid, 'is_new_user')
+        is_new_user = get_user_field(user, 'is_new_user')
         price = get_premium_price(days, is_new_user)
 
         if not await check_subscription(uid):
@@ -732,7 +2636,7 @@ async def buy_premium(cb: types.CallbackQuery, state: FSMContext):
             )
             return
 
-        payment_id = create_payment(uid, price, days)
+        payment_id = await create_payment(uid, price, days)
         payment_message = (
             f"🎵 *Оплата премиум-подписки SoundPlus*\n\n"
             f"📌 <b>Сумма к оплате:</b> {price} RUB\n"
@@ -751,7 +2655,7 @@ async def buy_premium(cb: types.CallbackQuery, state: FSMContext):
         kb.add(InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_buy"))
         kb.adjust(1)
         await cb.message.answer(payment_message, parse_mode="HTML", reply_markup=kb.as_markup())
-        if should_send_ad(uid):
+        if should_send_ad(user):
             await cb.message.answer(send_ad_text())
             reset_action_count(uid)
     except Exception as e:
@@ -783,8 +2687,8 @@ async def process_payment_screenshot(message: types.Message, state: FSMContext):
     file_path = file_info.file_path
     screenshot_path = f"temp/payment_{payment_id}.jpg"
     await bot.download_file(file_path, screenshot_path)
-    update_payment(payment_id, "pending", screenshot_path)
-    payment = get_payment(payment_id)
+    await update_payment(payment_id, "pending", screenshot_path)
+    payment = await get_payment(payment_id)
     if payment:
         user_id = payment[1]
         amount = payment[2]
@@ -824,7 +2728,7 @@ async def confirm_payment(cb: types.CallbackQuery):
         await cb.answer("❌ Доступ запрещён", show_alert=True)
         return
     payment_id = int(cb.data.split('_')[-1])
-    payment = get_payment(payment_id)
+    payment = await get_payment(payment_id)
     if not payment:
         await cb.answer("❌ Платеж не найден", show_alert=True)
         return
@@ -832,11 +2736,12 @@ async def confirm_payment(cb: types.CallbackQuery):
     amount = payment[2]
     days = payment[3]
     until = datetime.utcnow() + timedelta(days=days)
-    update_user(user_id, premium_until=until.isoformat(), is_new_user=False)
-    update_payment(payment_id, "completed")
-    referrer_id = get_user_field(user_id, 'referrer_id')
+    await update_user(user_id, premium_until=until.isoformat(), is_new_user=False)
+    await update_payment(payment_id, "completed")
+    payer = await load_user(user_id)
+    referrer_id = payer.referrer_id if payer else None
     if referrer_id:
-        update_referral_balance(referrer_id, user_id, amount)
+        await update_referral_balance(referrer_id, user_id, amount)
         await bot.send_message(
             referrer_id,
             f"🎉 Ваш реферал купил премиум!\n"
@@ -861,12 +2766,12 @@ async def reject_payment(cb: types.CallbackQuery):
         await cb.answer("❌ Доступ запрещён", show_alert=True)
         return
     payment_id = int(cb.data.split('_')[-1])
-    payment = get_payment(payment_id)
+    payment = await get_payment(payment_id)
     if not payment:
         await cb.answer("❌ Платеж не найден", show_alert=True)
         return
     user_id = payment[1]
-    update_payment(payment_id, "rejected")
+    await update_payment(payment_id, "rejected")
     await cb.message.edit_caption(
         f"❌ Платеж <code>{payment_id}</code> отклонен администратором @{cb.from_user.username}\n"
         f"👤 Пользователь: <code>{user_id}</code>",
@@ -883,21 +2788,21 @@ async def reject_payment(cb: types.CallbackQuery):
     )
 
 @dp.callback_query(lambda c: c.data.startswith("check_sub_prem_"))
-async def check_subscription_premium(cb: types.CallbackQuery, state: FSMContext):
+async def check_subscription_premium(cb: types.CallbackQuery, state: FSMContext, user: UserRecord):
     uid = cb.from_user.id
+    await subscription_cache.invalidate(uid)
     days = int(cb.data.split('_')[-1])
     if not await check_subscription(uid):
         await cb.answer("❌ Вы все еще не подписаны на канал", show_alert=True)
         return
     await cb.message.delete()
-    await buy_premium(cb, state)
+    await buy_premium(cb, state, user)
 
 @dp.callback_query(F.data == "back_to_buy")
-async def back_to_buy(cb: types.CallbackQuery):
-    uid = cb.from_user.id
-    get_user(uid)
+async def back_to_buy(cb: types.CallbackQuery, user: UserRecord):
+    uid = user.id
     increment_action_count(uid)
-    is_new_user = get_user_field(uid, 'is_new_user')
+    is_new_user = get_user_field(user, 'is_new_user')
     kb = InlineKeyboardBuilder()
     for k in PREMIUM_DAYS:
         days = int(k)
@@ -908,7 +2813,7 @@ async def back_to_buy(cb: types.CallbackQuery):
                                     callback_data=f"prem_{k}"))
     kb.adjust(1)
     await cb.message.answer("Выберите срок премиума:", reply_markup=kb.as_markup())
-    if should_send_ad(uid):
+    if should_send_ad(user):
         await cb.message.answer(send_ad_text())
         reset_action_count(uid)
 
@@ -918,8 +2823,7 @@ async def admin_review_payments(cb: types.CallbackQuery):
     if not is_admin(uid):
         await cb.answer("❌ Доступ запрещён", show_alert=True)
         return
-    cursor.execute("SELECT id, user_id, days, amount FROM payments WHERE status = 'pending'")
-    payments = cursor.fetchall()
+    payments = await db.fetchall("SELECT id, user_id, days, amount FROM payments WHERE status = 'pending'")
     if not payments:
         await cb.message.answer("📑 Нет ожидающих проверки платежей.")
         return
@@ -939,8 +2843,8 @@ async def review_payment(cb: types.CallbackQuery):
         return
     try:
         payment_id = int(cb.data.split('_')[-1])
-        cursor.execute("SELECT user_id, days, amount, screenshot FROM payments WHERE id = ?", (payment_id,))
-        payment = cursor.fetchone()
+        payment = await db.fetchone("SELECT user_id, days, amount, screenshot FROM payments WHERE id = ?",
+                                    (payment_id,))
         if not payment:
             await cb.message.answer("❌ Платёж не найден")
             return
@@ -981,7 +2885,7 @@ async def admin_enable_bot(cb: types.CallbackQuery):
     if not is_bot_disabled():
         await cb.message.answer("✅ Бот уже активен")
         return
-    enable_bot()
+    await enable_bot()
     await cb.message.answer("✅ Бот включен")
 
 @dp.callback_query(F.data == "admin_send_ad")
@@ -1007,14 +2911,14 @@ async def process_ad_message(message: types.Message, state: FSMContext):
         photo = message.photo[-1]
         file_info = await bot.get_file(photo.file_id)
         file_path = file_info.file_path
-        photo_path = f"temp/ad_photo_{uid}.jpg"
+        photo_path = f"temp/ad_photo_{uid}_{message.message_id}.jpg"
         await bot.download_file(file_path, photo_path)
         ad_text = message.caption or "Реклама"
     elif message.video:
         video = message.video
         file_info = await bot.get_file(video.file_id)
         file_path = file_info.file_path
-        video_path = f"temp/ad_video_{uid}.mp4"
+        video_path = f"temp/ad_video_{uid}_{message.message_id}.mp4"
         await bot.download_file(file_path, video_path)
         ad_text = message.caption or "Реклама"
     elif not ad_text:
@@ -1035,16 +2939,13 @@ async def process_button_title(message: types.Message, state: FSMContext):
     button_title = message.text.strip()
     if button_title.lower() == 'нет':
         data = await state.get_data()
-        count = await broadcast_message(
+        job_id = await start_broadcast(
+            uid,
             data['ad_text'],
             photo_path=data.get('photo_path'),
             video_path=data.get('video_path')
         )
-        await message.answer(f"✅ Реклама отправлена {count} пользователям")
-        if data.get('photo_path') and os.path.exists(data['photo_path']):
-            os.remove(data['photo_path'])
-        if data.get('video_path') and os.path.exists(data['video_path']):
-            os.remove(data['video_path'])
+        await message.answer(f"✅ Рассылка #{job_id} запущена. Прогресс обновляется в сообщении выше.")
         await state.clear()
         return
     await state.update_data(button_title=button_title)
@@ -1063,18 +2964,15 @@ async def process_button_url(message: types.Message, state: FSMContext):
         await message.answer("❌ Неверный формат URL. Введите корректный URL, начинающийся с http:// или https://")
         return
     data = await state.get_data()
-    count = await broadcast_message(
+    job_id = await start_broadcast(
+        uid,
         data['ad_text'],
         photo_path=data.get('photo_path'),
         video_path=data.get('video_path'),
         button_title=data['button_title'],
         button_url=button_url
     )
-    await message.answer(f"✅ Реклама с кнопкой отправлена {count} пользователям")
-    if data.get('photo_path') and os.path.exists(data['photo_path']):
-        os.remove(data['photo_path'])
-    if data.get('video_path') and os.path.exists(data['video_path']):
-        os.remove(data['video_path'])
+    await message.answer(f"✅ Рассылка #{job_id} с кнопкой запущена. Прогресс обновляется в сообщении выше.")
     await state.clear()
 
 @dp.callback_query(F.data == "admin_stats")
@@ -1091,7 +2989,26 @@ async def admin_stats(cb: types.CallbackQuery):
         f"🎵 Всего скачиваний: <b>{stats['total_downloads']}</b>\n"
         f"👤 Пользователи с рефералами: <b>{stats['users_with_referrals']}</b>\n"
         f"📑 Ожидающие платежи: <b>{stats['pending_payments']}</b>\n"
+        f"💾 Кэш аудио: <b>{stats['audio_cache']['files']}</b> файлов, "
+        f"<b>{stats['audio_cache']['bytes'] // (1024 * 1024)} МБ</b>\n"
+        f"🎯 Попадания/промахи/вытеснения: <b>{stats['audio_cache']['hits']}/"
+        f"{stats['audio_cache']['misses']}/{stats['audio_cache']['evictions']}</b>\n"
+        f"📥 Скачано/впустую: <b>{stats['downloads']['downloaded_bytes'] // (1024 * 1024)}/"
+        f"{stats['downloads']['wasted_bytes'] // (1024 * 1024)} МБ</b>, "
+        f"отклонено заранее: <b>{stats['downloads']['rejected']}</b>\n"
+        f"⏱ Задержка event loop: <b>{stats['loop_lag']['avg_ms']:.1f}</b> мс "
+        f"(макс. <b>{stats['loop_lag']['max_ms']:.0f}</b> мс)\n"
+        f"📢 Кэш подписок: <b>{stats['subscriptions']['entries']}</b> записей, "
+        f"попадания/промахи <b>{stats['subscriptions']['hits']}/{stats['subscriptions']['misses']}</b>\n"
+        f"🔮 Предзагрузка: <b>{stats['prefetch']['used']}/{stats['prefetch']['completed']}</b> пригодилось "
+        f"(<b>{stats['prefetch']['hit_rate']:.0%}</b>), <b>{stats['prefetch']['bytes'] // (1024 * 1024)} МБ</b>\n"
     )
+    for name, stage in stats['stages'].items():
+        text += (
+            f"📶 {name}: очередь <b>{stage['queued']}</b>, в работе <b>{stage['active']}</b>, "
+            f"ожидание <b>{stage['wait_ms']:.0f}</b> мс, работа <b>{stage['service_ms']:.0f}</b> мс, "
+            f"отклонено <b>{stage['rejected']}</b>\n"
+        )
     await cb.message.answer(text, parse_mode="HTML")
 
 @dp.callback_query(F.data == "admin_grant_premium")
@@ -1112,8 +3029,7 @@ async def process_premium_user(message: types.Message, state: FSMContext):
         return
     try:
         user_id = int(message.text.strip())
-        cursor.execute("SELECT id FROM users WHERE id = ?", (user_id,))
-        if not cursor.fetchone():
+        if not await db.fetchone("SELECT id FROM users WHERE id = ?", (user_id,)):
             await message.answer("❌ Пользователь не найден")
             await state.clear()
             return
@@ -1143,7 +3059,7 @@ async def process_premium_days(cb: types.CallbackQuery, state: FSMContext):
             await state.clear()
             return
         until = datetime.utcnow() + timedelta(days=days)
-        update_user(user_id, premium_until=until.isoformat(), is_new_user=False)
+        await update_user(user_id, premium_until=until.isoformat(), is_new_user=False)
         await cb.message.answer(f"✅ Пользователю {user_id} выдан премиум на {days // 30} месяцев")
         await bot.send_message(user_id, f"🎉 Вам выдан премиум на {days // 30} месяцев!")
         await state.clear()
@@ -1159,10 +3075,11 @@ async def admin_disable_bot(cb: types.CallbackQuery, state: FSMContext):
         await cb.answer("❌ Доступ запрещён", show_alert=True)
         return
     if is_bot_disabled():
-        cursor.execute("SELECT disabled_until FROM bot_status WHERE id = 1")
-        disabled_until = cursor.fetchone()[0]
-        until = datetime.fromisoformat(disabled_until).strftime('%d.%m.%Y %H:%M:%S UTC')
-        await cb.message.answer(f"⚠️ Бот уже отключен до {until}")
+        if bot_status.disabled_until:
+            until = datetime.fromisoformat(bot_status.disabled_until).strftime('%d.%m.%Y %H:%M:%S UTC')
+            await cb.message.answer(f"⚠️ Бот уже отключен до {until}")
+        else:
+            await cb.message.answer("⚠️ Бот уже отключен")
         return
     await cb.message.answer("Введите количество минут, на которое нужно отключить бота (например, 30):")
     await state.set_state(AdminStates.waiting_for_disable_duration)
@@ -1179,7 +3096,7 @@ async def process_disable_duration(message: types.Message, state: FSMContext):
         if minutes <= 0:
             await message.answer("❌ Введите положительное число минут")
             return
-        disable_bot(minutes)
+        await disable_bot(minutes)
         until = (datetime.utcnow() + timedelta(minutes=minutes)).strftime('%d.%m.%Y %H:%M:%S UTC')
         await message.answer(f"✅ Бот отключен на {minutes} минут. Будет активен после {until}")
         await state.clear()
@@ -1187,125 +3104,207 @@ async def process_disable_duration(message: types.Message, state: FSMContext):
         await message.answer("❌ Неверный формат. Введите число минут")
 
 @dp.message(F.text == "👤 Профиль")
-async def cmd_profile(message: types.Message):
+async def cmd_profile(message: types.Message, user: UserRecord):
     if is_bot_disabled():
         await message.answer("⚠️ Бот временно отключен. Попробуйте позже.")
         return
-    user_id = message.from_user.id
-    get_user(user_id)
+    user_id = user.id
     increment_action_count(user_id)
-    balance = get_user_field(user_id, 'balance') or 0
-    referrals = get_user_field(user_id, 'referrals') or 0
-    lang = get_user_field(user_id, 'lang') or 'Русский'
-    premium_until = get_user_field(user_id, 'premium_until')
+    balance = get_user_field(user, 'balance') or 0
+    referrals = get_user_field(user, 'referrals') or 0
+    lang = get_user_field(user, 'lang') or 'Русский'
+    premium_until = get_user_field(user, 'premium_until')
     text = (
         f"👤 <b>Профиль</b>\n"
         f"🆔 ID: <code>{user_id}</code>\n"
         f"💰 Баланс: <b>{balance}₽</b>\n"
         f"👥 Рефералы: <b>{referrals}</b>\n"
         f"🌐 Язык: <b>{lang}</b>\n"
-        f"💎 Premium: <b>{'✅ Активен' if has_premium(user_id) else '❌ Нет'}</b>\n"
+        f"💎 Premium: <b>{'✅ Активен' if has_premium(user) else '❌ Нет'}</b>\n"
         f"📌 Ваша ссылка:\n"
         f"<code>https://t.me/SoundPlus_bot?start=ref={user_id}</code>\n\n"
         f"📢 Дайте друзьям эту ссылку, и вы оба получите вознаграждение!"
     )
-    if has_premium(user_id) and premium_until:
+    if has_premium(user) and premium_until:
         until_date = datetime.fromisoformat(premium_until).strftime('%d.%m.%Y')
         text += f"⏳ Подписка до: <b>{until_date}</b>\n"
     inline_kb = InlineKeyboardBuilder()
     inline_kb.add(InlineKeyboardButton(text="📅 Купить премиум", callback_data="buy"))
     await message.answer(text, reply_markup=inline_kb.as_markup(), parse_mode="HTML")
-    if should_send_ad(user_id):
+    if should_send_ad(user):
         await message.answer(send_ad_text())
         reset_action_count(user_id)
 
 @dp.callback_query(F.data == "search")
-async def prompt_search(cb: types.CallbackQuery, state: FSMContext):
+async def prompt_search(cb: types.CallbackQuery, state: FSMContext, user: UserRecord):
     if is_bot_disabled():
         await cb.message.answer("⚠️ Бот временно отключен. Попробуйте позже.")
         return
-    uid = cb.from_user.id
+    uid = user.id
     increment_action_count(uid)
     await cb.message.answer("🔍 Введите название или исполнителя для поиска на YouTube:")
     await state.set_state(SearchStates.searching)
-    if should_send_ad(uid):
+    if should_send_ad(user):
         await cb.message.answer(send_ad_text())
         reset_action_count(uid)
 
 @dp.message(SearchStates.searching)
-async def process_search(message: types.Message, state: FSMContext):
+async def process_search(message: types.Message, state: FSMContext, user: UserRecord):
     if is_bot_disabled():
         await message.answer("⚠️ Бот временно отключен. Попробуйте позже.")
         return
-    uid = message.from_user.id
-    get_user(uid)
+    uid = user.id
     increment_action_count(uid)
     query = message.text.strip()
-    results = await youtube_search(query)
+    try:
+        results = await youtube_search(query)
+    except StageBusyError:
+        # Keep the search state so the user can just send the query again
+        await message.answer("⚠️ Сервис перегружен. Попробуйте через минуту.")
+        return
     await state.clear()
     if not results:
         await message.answer("❌ Ничего не найдено по запросу.")
         return
-    await state.update_data(search_results=results)
-    await render_search_results(message, results)
-    if should_send_ad(uid):
+    await render_search_results(message, results, user)
+    if should_send_ad(user):
         await message.answer(send_ad_text())
         reset_action_count(uid)
 
-async def render_search_results(message: types.Message, results, page=0):
+class ResultStore:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def put(self, results):
+        # (video_id, title, artist, duration) tuples; interning shares strings across sessions seeing the same tracks
+        rows = tuple(
+            (sys.intern(item['video_id']), sys.intern(item['title']), sys.intern(item['artist']),
+             sys.intern(item['duration']))
+            for item in results
+        )
+        # Tokens are shared through the database by all workers, so they need more bits than one process would
+        token = secrets.token_hex(8)
+        while token in self.entries:
+            token = secrets.token_hex(8)
+        self.add(token, rows)
+        return token
+
+    def add(self, token, rows):
+        self.entries[token] = (rows, time.time())
+        self.evict()
+
+    def get(self, token):
+        entry = self.entries.get(token)
+        if not entry:
+            return None
+        rows, touched_at = entry
+        if time.time() - touched_at > self.ttl:
+            del self.entries[token]
+            return None
+        self.entries[token] = (rows, time.time())
+        self.entries.move_to_end(token)
+        return rows
+
+    def evict(self):
+        now = time.time()
+        while self.entries:
+            token, (_, touched_at) = next(iter(self.entries.items()))
+            if len(self.entries) <= self.max_size and now - touched_at <= self.ttl:
+                break
+            del self.entries[token]
+
+result_store = ResultStore(RESULT_STORE_SIZE, RESULT_STORE_TTL)
+
+async def save_result_set(token, rows):
+    await db.execute(
+        "INSERT OR REPLACE INTO result_sets (token, rows, expires_at) VALUES (?, ?, ?)",
+        (token, json.dumps(rows), time.time() + RESULT_STORE_TTL)
+    )
+
+async def load_result_set(token):
+    # The process-local store is a cache; a page press may land on a worker that did not run the search
+    rows = result_store.get(token)
+    if rows is None:
+        row = await db.fetchone("SELECT rows FROM result_sets WHERE token = ? AND expires_at > ?", (token, time.time()))
+        if not row:
+            return None
+        rows = tuple(tuple(sys.intern(value) for value in item) for item in json.loads(row[0]))
+        result_store.add(token, rows)
+    await db.execute("UPDATE result_sets SET expires_at = ? WHERE token = ?", (time.time() + RESULT_STORE_TTL, token))
+    return rows
+
+def search_results_markup(token, rows, page):
     ITEMS_PER_PAGE = 5
-    total = len(results)
+    total = len(rows)
     start = page * ITEMS_PER_PAGE
     end = start + ITEMS_PER_PAGE
-    page_results = results[start:end]
     kb = InlineKeyboardBuilder()
-    for item in page_results:
+    for video_id, title, artist, duration in rows[start:end]:
         kb.row(InlineKeyboardButton(
-            text=f"{item['title']} [{item['duration']}]",
-            callback_data=f"select_{item['video_id']}"
+            text=f"{title} [{duration}]",
+            callback_data=f"select_{video_id}"
         ))
     nav = []
     if start > 0:
-        nav.append(InlineKeyboardButton(text="⏮ Назад", callback_data=f"page_{page - 1}"))
+        nav.append(InlineKeyboardButton(text="⏮ Назад", callback_data=f"page_{token}_{page - 1}"))
     if end < total:
-        nav.append(InlineKeyboardButton(text="Дальше ⏭", callback_data=f"page_{page + 1}"))
+        nav.append(InlineKeyboardButton(text="Дальше ⏭", callback_data=f"page_{token}_{page + 1}"))
     if nav:
         kb.row(*nav)
-    await message.answer("Результаты поиска:", reply_markup=kb.as_markup())
+    return kb.as_markup()
+
+async def render_search_results(message: types.Message, results, user):
+    if can_download(user):
+        fmt = audio_format_for(has_premium(user))
+        for item in results[:PREFETCH_TOP_RESULTS]:
+            prefetcher.submit(item['video_id'], fmt, item)
+    token = result_store.put(results)
+    rows = result_store.get(token)
+    await save_result_set(token, rows)
+    await message.answer("Результаты поиска:", reply_markup=search_results_markup(token, rows, 0))
 
 @dp.callback_query(lambda c: c.data.startswith("page_"))
-async def cb_pagination(callback: types.CallbackQuery, state: FSMContext):
+async def cb_pagination(callback: types.CallbackQuery, user: UserRecord):
     if is_bot_disabled():
         await callback.message.answer("⚠️ Бот временно отключен. Попробуйте позже.")
         return
-    uid = callback.from_user.id
+    uid = user.id
     increment_action_count(uid)
-    page = int(callback.data.split("_")[1])
-    query_data = await state.get_data()
-    results = query_data.get("search_results")
-    if not results:
-        await callback.message.answer("Результаты поиска не найдены.")
+    parts = callback.data.split("_")
+    # Buttons from before the result store carried only the page number
+    rows = await load_result_set(parts[1]) if len(parts) == 3 else None
+    if not rows:
+        await callback.answer("Результаты поиска устарели, повторите поиск.", show_alert=True)
         return
-    await render_search_results(callback.message, results, page)
+    try:
+        await callback.message.edit_reply_markup(reply_markup=search_results_markup(parts[1], rows, int(parts[2])))
+    except TelegramBadRequest as e:
+        # Double taps produce "message is not modified"
+        logger.warning(f"Failed to edit search results page: {e}")
     await callback.answer()
-    if should_send_ad(uid):
+    if should_send_ad(user):
         await callback.message.answer(send_ad_text())
         reset_action_count(uid)
 
 @dp.callback_query(lambda c: c.data.startswith("select_"))
-async def cb_select_track(callback: types.CallbackQuery):
+async def cb_select_track(callback: types.CallbackQuery, user: UserRecord):
     if is_bot_disabled():
         await callback.message.answer("⚠️ Бот временно отключен. Попробуйте позже.")
         return
-    uid = callback.from_user.id
+    uid = user.id
     increment_action_count(uid)
     video_id = callback.data[len("select_"):]
-    ydl_opts = {'quiet': True, 'nocheckcertificate': True}
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(f"https://www.youtube.com/watch?v={video_id}", download=False)
-        title = info.get('title', 'Unknown')
-        duration = info.get('duration')
-        duration_str = format_duration(duration)
+    try:
+        track = await track_store.get(video_id)
+    except StageBusyError:
+        await callback.message.answer("⚠️ Сервис перегружен. Попробуйте через минуту.")
+        return
+    title = track['title']
+    duration_str = track['duration']
+    if can_download(user):
+        prefetcher.submit(video_id, audio_format_for(has_premium(user)), track)
     kb = InlineKeyboardBuilder()
     kb.add(InlineKeyboardButton(text="▶️ Прослушать", callback_data=f"play_{video_id}"))
     kb.add(InlineKeyboardButton(text="⭐ Добавить в избранное", callback_data=f"fav_{video_id}"))
@@ -1314,91 +3313,114 @@ async def cb_select_track(callback: types.CallbackQuery):
         reply_markup=kb.as_markup(),
         parse_mode="HTML"
     )
-    if should_send_ad(uid):
+    if should_send_ad(user):
         await callback.message.answer(send_ad_text())
         reset_action_count(uid)
 
 @dp.callback_query(lambda c: c.data.startswith("play_"))
-async def cb_play(callback: types.CallbackQuery):
+async def cb_play(callback: types.CallbackQuery, user: UserRecord):
     if is_bot_disabled():
         await callback.message.answer("⚠️ Бот временно отключен. Попробуйте позже.")
         return
     video_id = callback.data[len("play_"):]
-    uid = callback.from_user.id
+    uid = user.id
     increment_action_count(uid)
-    if not can_download(uid):
+    if not can_download(user):
         await callback.message.answer(
             "❌ Вы достигли лимита в 30 треков для бесплатного тарифа. Купите премиум для неограниченного доступа!"
         )
         return
     try:
-        ydl_opts = {'quiet': True, 'nocheckcertificate': True}
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(f"https://www.youtube.com/watch?v={video_id}", download=False)
-            title = info.get('title', 'Unknown')
-            duration = info.get('duration')
-            duration_str = format_duration(duration)
-            artist = info.get('uploader', 'Unknown Artist')
-        audio_path = await download_audio(video_id, title=title)
-        if not audio_path:
-            await callback.message.answer("❌ Ошибка: файл слишком большой или не удалось скачать.")
-            return
-        audio = FSInputFile(audio_path)
-        await callback.message.answer_audio(audio)
-        log_history(uid, {
+        track = await track_store.get(video_id)
+        title = track['title']
+        duration_str = track['duration']
+        artist = track['artist']
+        sent = None
+        fmt = audio_format_for(has_premium(user))
+        file_id = await get_audio_file_id(video_id, fmt)
+        if file_id:
+            try:
+                sent = await callback.message.answer_audio(file_id)
+            except TelegramBadRequest as e:
+                logger.warning(f"Cached file_id for {video_id} ({fmt}) was rejected: {e}")
+                await forget_audio_file_id(video_id, fmt)
+        if not sent:
+            audio_path = await audio_cache.get(video_id, fmt)
+            if not audio_path:
+                job = download_scheduler.submit(
+                    uid, has_premium(user), functools.partial(prepare_audio, video_id, fmt, track)
+                )
+                audio_path, fmt = await wait_for_download(job, callback.message)
+            prefetcher.claim(video_id, fmt)
+            if not audio_path:
+                await callback.message.answer("❌ Ошибка: файл слишком большой или не удалось скачать.")
+                return
+            audio = FSInputFile(audio_path)
+            sent = await upload_stage.run(callback.message.answer_audio, audio, title=title, performer=artist)
+            if sent.audio:
+                await save_audio_file_id(video_id, fmt, sent.audio.file_id, sent.audio.file_unique_id)
+        await log_history(uid, {
             'video_id': video_id,
             'title': title,
             'artist': artist,
             'duration': duration_str
         })
-        if not has_premium(uid):
-            current_total = get_user_field(uid, 'total_downloads') or 0
-            update_user(uid, total_downloads=current_total + 1)
-        if should_send_ad(uid):
+        if not has_premium(user):
+            counter_store.increment_downloads(uid)
+        if should_send_ad(user):
             await callback.message.answer(send_ad_text())
             reset_action_count(uid)
+    except StageBusyError:
+        await callback.message.answer("⚠️ Сервис перегружен. Попробуйте через минуту.")
+    except DownloadError as e:
+        await callback.message.answer(f"❌ Не удалось скачать: {e}.")
     except Exception as e:
         logger.error(f"Error in cb_play: {e}")
         await callback.message.answer(f"❌ Ошибка при загрузке аудио: {e}")
 
 @dp.callback_query(lambda c: c.data.startswith("fav_"))
-async def cb_favorite(callback: types.CallbackQuery):
+async def cb_favorite(callback: types.CallbackQuery, user: UserRecord):
     if is_bot_disabled():
         await callback.message.answer("⚠️ Бот временно отключен. Попробуйте позже.")
         return
     video_id = callback.data[len("fav_"):]
-    user_id = callback.from_user.id
+    user_id = user.id
     increment_action_count(user_id)
-    ydl_opts = {'quiet': True, 'nocheckcertificate': True}
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(f"https://www.youtube.com/watch?v={video_id}", download=False)
-        title = info.get('title', 'Unknown')
-        duration = info.get('duration')
-        duration_str = format_duration(duration)
-        artist = info.get('uploader', 'Unknown Artist')
-    cursor.execute(
+    try:
+        track = await track_store.get(video_id)
+    except StageBusyError:
+        await callback.message.answer("⚠️ Сервис перегружен. Попробуйте через минуту.")
+        return
+    title = track['title']
+    duration_str = track['duration']
+    artist = track['artist']
+    result = await db.execute(
         """
-        INSERT INTO favorites (user_id, video_id, title, artist, duration, created_at, source)
+        INSERT OR IGNORE INTO favorites (user_id, video_id, title, artist, duration, created_at, source)
         VALUES (?, ?, ?, ?, ?, ?, ?)
         """,
         (user_id, video_id, title, artist, duration_str, datetime.utcnow().isoformat(), 'youtube')
     )
-    conn.commit()
-    await callback.message.answer("✅ Добавлено в избранное!")
-    if should_send_ad(user_id):
+    if result.rowcount:
+        recommender.add(user_id, video_id)
+        await callback.message.answer("✅ Добавлено в избранное!")
+    else:
+        await callback.message.answer("⭐ Этот трек уже в избранном.")
+    if should_send_ad(user):
         await callback.message.answer(send_ad_text())
         reset_action_count(user_id)
 
 @dp.message(F.text == "🕘 История")
-async def cmd_history(message: types.Message):
+async def cmd_history(message: types.Message, user: UserRecord):
     if is_bot_disabled():
         await message.answer("⚠️ Бот временно отключен. Попробуйте позже.")
         return
-    user_id = message.from_user.id
+    user_id = user.id
     increment_action_count(user_id)
-    cursor.execute("SELECT video_id, title, duration FROM history WHERE user_id=? ORDER BY created_at DESC LIMIT 10",
-                   (user_id,))
-    rows = cursor.fetchall()
+    rows = await db.fetchall(
+        "SELECT video_id, title, duration FROM history WHERE user_id=? ORDER BY created_at DESC LIMIT 10",
+        (user_id,)
+    )
     if not rows:
         await message.answer("История пуста.")
         return
@@ -1406,20 +3428,21 @@ async def cmd_history(message: types.Message):
     for vid, title, duration in rows:
         text += f"{title} [{duration}]\n"
     await message.answer(text)
-    if should_send_ad(user_id):
+    if should_send_ad(user):
         await message.answer(send_ad_text())
         reset_action_count(user_id)
 
 @dp.message(F.text == "⭐ Избранное")
-async def cmd_favorites(message: types.Message):
+async def cmd_favorites(message: types.Message, user: UserRecord):
     if is_bot_disabled():
         await message.answer("⚠️ Бот временно отключен. Попробуйте позже.")
         return
-    user_id = message.from_user.id
+    user_id = user.id
     increment_action_count(user_id)
-    cursor.execute("SELECT video_id, title, duration FROM favorites WHERE user_id=? ORDER BY created_at DESC LIMIT 10",
-                   (user_id,))
-    rows = cursor.fetchall()
+    rows = await db.fetchall(
+        "SELECT video_id, title, duration FROM favorites WHERE user_id=? ORDER BY created_at DESC LIMIT 10",
+        (user_id,)
+    )
     if not rows:
         await message.answer("Избранных треков нет.")
         return
@@ -1427,12 +3450,12 @@ async def cmd_favorites(message: types.Message):
     for vid, title, duration in rows:
         text += f"{title} [{duration}]\n"
     await message.answer(text)
-    if should_send_ad(user_id):
+    if should_send_ad(user):
         await message.answer(send_ad_text())
         reset_action_count(user_id)
 
 @dp.message(F.text == "🔍 Поиск музыки")
-async def cmd_search(message: types.Message, state: FSMContext):
+async def cmd_search(message: types.Message, state: FSMContext, user: UserRecord):
     if is_bot_disabled():
         await message.answer("⚠️ Бот временно отключен. Попробуйте позже.")
         return
@@ -1440,56 +3463,50 @@ async def cmd_search(message: types.Message, state: FSMContext):
     await state.set_state(SearchStates.searching)
 
 @dp.message(F.text == "🆕 Новинки")
-async def cmd_new_releases(message: types.Message, state: FSMContext):
+async def cmd_new_releases(message: types.Message, state: FSMContext, user: UserRecord):
     if is_bot_disabled():
         await message.answer("⚠️ Бот временно отключен. Попробуйте позже.")
         return
-    uid = message.from_user.id
-    get_user(uid)
+    uid = user.id
     increment_action_count(uid)
     results = await get_new_releases()
     if not results:
         await message.answer("❌ Не удалось найти новинки.")
         return
-    await state.update_data(search_results=results)
-    await render_search_results(message, results)
-    if should_send_ad(uid):
+    await render_search_results(message, results, user)
+    if should_send_ad(user):
         await message.answer(send_ad_text())
         reset_action_count(uid)
 
 @dp.message(F.text == "🏆 Топ песен")
-async def cmd_top_songs(message: types.Message, state: FSMContext):
+async def cmd_top_songs(message: types.Message, state: FSMContext, user: UserRecord):
     if is_bot_disabled():
         await message.answer("⚠️ Бот временно отключен. Попробуйте позже.")
         return
-    uid = message.from_user.id
-    get_user(uid)
+    uid = user.id
     increment_action_count(uid)
     results = await get_top_songs()
     if not results:
         await message.answer("❌ Не удалось найти популярные треки.")
         return
-    await state.update_data(search_results=results)
-    await render_search_results(message, results)
-    if should_send_ad(uid):
+    await render_search_results(message, results, user)
+    if should_send_ad(user):
         await message.answer(send_ad_text())
         reset_action_count(uid)
 
 @dp.message(F.text == "🌊 Моя волна")
-async def cmd_my_wave(message: types.Message, state: FSMContext):
+async def cmd_my_wave(message: types.Message, state: FSMContext, user: UserRecord):
     if is_bot_disabled():
         await message.answer("⚠️ Бот временно отключен. Попробуйте позже.")
         return
-    uid = message.from_user.id
-    get_user(uid)
+    uid = user.id
     increment_action_count(uid)
     results = await get_my_wave(uid)
     if not results:
         await message.answer("❌ Не удалось сформировать рекомендации.")
         return
-    await state.update_data(search_results=results)
-    await render_search_results(message, results)
-    if should_send_ad(uid):
+    await render_search_results(message, results, user)
+    if should_send_ad(user):
         await message.answer(send_ad_text())
         reset_action_count(uid)
 
@@ -1512,38 +3529,213 @@ async def cmd_admin_panel(message: types.Message):
     kb.row(InlineKeyboardButton(text="📑 Проверить платежи", callback_data="admin_review_payments"))
     await message.answer("🛠 Админ-панель:", reply_markup=kb.as_markup())
 
+RUSSIAN_ARTISTS = ['Мона', 'Наваи', 'Артик', 'Асти', 'Саби', 'Елка', 'Баста', 'Ёлка', 'Дима Билан',
+                   'Полина Гагарина', 'Сергей Лазарев', 'Нюша', 'Зиверт', 'Макс Барских', 'ЛСП', 'Клава Кока',
+                   'Егор Крид', 'Ольга Бузова', 'Тима Белорусских', 'Мот']
+
+CHART_QUERIES = {
+    'new_releases': [f"{artist} новые песни" for artist in RUSSIAN_ARTISTS[:5]],
+    'top_songs': [f"{artist} популярные песни" for artist in RUSSIAN_ARTISTS[:5]],
+}
+
+def replace_chart(cursor, name, video_ids, generated_at):
+    cursor.execute("DELETE FROM chart_entries WHERE chart = ?", (name,))
+    cursor.executemany(
+        "INSERT INTO chart_entries (chart, position, video_id) VALUES (?, ?, ?)",
+        [(name, position, video_id) for position, video_id in enumerate(video_ids)]
+    )
+    cursor.execute(
+        "INSERT INTO charts (name, generated_at) VALUES (?, ?) "
+        "ON CONFLICT(name) DO UPDATE SET generated_at = excluded.generated_at",
+        (name, generated_at)
+    )
+
+class ChartStore:
+    def __init__(self, queries, refresh_interval, prewarm_count):
+        self.queries = queries
+        self.refresh_interval = refresh_interval
+        self.prewarm_count = prewarm_count
+        self.snapshots = {}
+        self.flights = SingleFlight()
+
+    async def load(self):
+        for name, generated_at in await db.fetchall("SELECT name, generated_at FROM charts"):
+            rows = await db.fetchall(
+                """
+                SELECT t.video_id, t.title, t.artist, t.duration FROM chart_entries c
+                JOIN tracks t ON t.video_id = c.video_id
+                WHERE c.chart = ? ORDER BY c.position
+                """, (name,))
+            results = [{'video_id': v, 'title': t, 'artist': a, 'duration': d} for v, t, a, d in rows]
+            self.snapshots[name] = (results, generated_at)
+        logger.info(f"Loaded {len(self.snapshots)} chart snapshots")
+
+    def age(self, name):
+        snapshot = self.snapshots.get(name)
+        return time.time() - snapshot[1] if snapshot else None
+
+    async def get(self, name):
+        snapshot = self.snapshots.get(name)
+        if snapshot and snapshot[0]:
+            return list(snapshot[0])
+        # No snapshot yet (first start): build it now, sharing the work with the scheduler
+        return list(await self.refresh(name))
+
+    async def refresh(self, name):
+        return await self.flights.run(name, functools.partial(self.build, name))
+
+    async def build(self, name):
+        results = await fan_out_search(self.queries[name])
+        if not results:
+            logger.warning(f"Chart {name} came back empty, keeping previous snapshot")
+            snapshot = self.snapshots.get(name)
+            return snapshot[0] if snapshot else []
+        generated_at = time.time()
+        await db.transaction(replace_chart, name, [item['video_id'] for item in results], generated_at)
+        self.snapshots[name] = (results, generated_at)
+        logger.info(f"Chart {name} refreshed with {len(results)} tracks")
+        return results
+
+    def prewarm(self, name):
+        snapshot = self.snapshots.get(name)
+        if not snapshot:
+            return
+        # Queued as prefetches so they only use spare download capacity and count against the budget;
+        # the prefetcher starts the newest submission first, so submit the top of the chart last.
+        # Most plays are free tier; fetch skips tracks that already have a file_id or a cached file
+        for item in reversed(snapshot[0][:self.prewarm_count]):
+            prefetcher.submit(item['video_id'], audio_format_for(False), item)
+
+    async def run(self):
+        while True:
+            for name in self.queries:
+                age = self.age(name)
+                if age is not None and age < self.refresh_interval:
+                    continue
+                try:
+                    await self.refresh(name)
+                    self.prewarm(name)
+                except Exception as e:
+                    logger.error(f"Error refreshing chart {name}: {e}")
+            await asyncio.sleep(min(self.refresh_interval, 60))
+
+chart_store = ChartStore(CHART_QUERIES, CHART_REFRESH_INTERVAL, CHART_PREWARM_COUNT)
+chart_task = None
+
 async def get_new_releases():
-    russian_artists = ['Мона', 'Наваи', 'Артик', 'Асти', 'Саби', 'Елка', 'Баста', 'Ёлка', 'Дима Билан',
-                       'Полина Гагарина', 'Сергей Лазарев', 'Нюша', 'Зиверт', 'Макс Барских', 'ЛСП', 'Клава Кока',
-                       'Егор Крид', 'Ольга Бузова', 'Тима Белорусских', 'Мот']
-    query = " ".join([f"{artist} новые песни" for artist in russian_artists[:5]]) + " официальный аудио музыка"
-    results = await youtube_search(query, max_results=20, max_duration=600, exclude_playlists=True)
-    return results
+    return await chart_store.get('new_releases')
 
 async def get_top_songs():
-    russian_artists = ['Мона', 'Наваи', 'Артик', 'Асти', 'Саби', 'Елка', 'Баста', 'Ёлка', 'Дима Билан',
-                       'Полина Гагарина', 'Сергей Лазарев', 'Нюша', 'Зиверт', 'Макс Барских', 'ЛСП', 'Клава Кока',
-                       'Егор Крид', 'Ольга Бузова', 'Тима Белорусских', 'Мот']
-    query = " ".join([f"{artist} популярные песни" for artist in russian_artists[:5]]) + " официальный аудио музыка"
-    results = await youtube_search(query, max_results=20, max_duration=600, exclude_playlists=True)
-    return results
+    return await chart_store.get('top_songs')
+
+async def lookup_played_tracks(video_ids):
+    # Tracks played before the tracks table existed only have metadata in history/favorites
+    placeholders = ', '.join('?' * len(video_ids))
+    rows = await db.fetchall(
+        f"SELECT video_id, title, artist, duration FROM history WHERE video_id IN ({placeholders}) "
+        f"UNION SELECT video_id, title, artist, duration FROM favorites WHERE video_id IN ({placeholders})",
+        (*video_ids, *video_ids)
+    )
+    tracks = {}
+    for video_id, title, artist, duration in rows:
+        tracks.setdefault(video_id, {'video_id': video_id, 'title': title, 'artist': artist, 'duration': duration})
+    if tracks:
+        await track_store.put_many(list(tracks.values()))
+    return tracks
 
 async def get_my_wave(user_id: int):
-    cursor.execute(
-        "SELECT artist FROM history WHERE user_id = ? ORDER BY created_at DESC LIMIT 10",
-        (user_id,)
+    recommended = recommender.recommend(user_id, 20)
+    tracks = {}
+    for video_id in recommended:
+        entry = await track_store.lookup(video_id)
+        if entry:
+            tracks[video_id] = entry[0]
+    missing = [video_id for video_id in recommended if video_id not in tracks]
+    if missing:
+        tracks.update(await lookup_played_tracks(missing))
+    results = [tracks[video_id] for video_id in recommended if video_id in tracks]
+    if len(results) < 20:
+        # Cold start or a thin neighbourhood: top up from the chart snapshot
+        seen = {item['video_id'] for item in results}
+        results += [item for item in await get_top_songs() if item['video_id'] not in seen][:20 - len(results)]
+    return results
+
+@dp.startup()
+async def on_startup():
+    await db.start()
+    global loop_lag_task
+    loop_lag_task = asyncio.create_task(loop_lag_monitor.run())
+    await bot_status.load()
+    global bot_status_task
+    bot_status_task = asyncio.create_task(bot_status.watch())
+    os.makedirs('temp', exist_ok=True)
+    await audio_cache.scan()
+    global broadcast_watch_task
+    broadcast_watch_task = asyncio.create_task(watch_broadcasts())
+    global counter_flush_task
+    counter_flush_task = asyncio.create_task(flush_counters_periodically())
+    await chart_store.load()
+    global chart_task
+    chart_task = asyncio.create_task(chart_store.run())
+    global recommender_task
+    recommender_task = asyncio.create_task(rebuild_recommender_periodically())
+    global prefetcher_task
+    prefetcher_task = asyncio.create_task(prefetcher.run())
+    upload_stage.start()
+    global fsm_purge_task
+    fsm_purge_task = asyncio.create_task(purge_fsm_periodically())
+
+@dp.shutdown()
+async def on_shutdown():
+    if counter_flush_task:
+        counter_flush_task.cancel()
+    if loop_lag_task:
+        loop_lag_task.cancel()
+    if bot_status_task:
+        bot_status_task.cancel()
+    if chart_task:
+        chart_task.cancel()
+    if recommender_task:
+        recommender_task.cancel()
+    if prefetcher_task:
+        prefetcher_task.cancel()
+    upload_stage.stop()
+    if fsm_purge_task:
+        fsm_purge_task.cancel()
+    if broadcast_watch_task:
+        broadcast_watch_task.cancel()
+    # Hands running broadcasts to the other workers right away instead of after the lease expires
+    await release_broadcasts()
+    await counter_store.flush()
+    await db.close()
+
+async def register_webhook(bot: Bot):
+    await bot.set_webhook(
+        f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types()
     )
-    artists = [row[0] for row in cursor.fetchall()]
-    russian_artists = ['Мона', 'Наваи', 'Артик', 'Асти', 'Саби', 'Елка', 'Баста', 'Ёлка', 'Дима Билан',
-                       'Полина Гагарина', 'Сергей Лазарев', 'Нюша', 'Зиверт', 'Макс Барских', 'ЛСП', 'Клава Кока',
-                       'Егор Крид', 'Ольга Бузова', 'Тима Белорусских', 'Мот']
-    if not artists:
-        return await get_top_songs()
-    artists = [a for a in artists if a in russian_artists] or russian_artists[:5]
-    queries = [f"{artist} песня" for artist in artists[:5]]
-    query = " ".join(queries) + " русские хиты музыка"
-    results = await youtube_search(query, max_results=20, max_duration=600, exclude_playlists=True)
-    return results if results else await get_top_songs()
+    logger.info(f"Webhook registered at {WEBHOOK_URL}{WEBHOOK_PATH}")
+
+def create_webhook_app():
+    app = web.Application()
+    # Requests without the matching X-Telegram-Bot-Api-Secret-Token header are rejected with 401
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    # Ties dp startup/shutdown hooks (DB, background tasks, flushes) to the aiohttp app lifecycle
+    setup_application(app, dp, bot=bot)
+    return app
+
+def run_webhook():
+    dp.startup.register(register_webhook)
+    web.run_app(create_webhook_app(), host=WEBAPP_HOST, port=WEBAPP_PORT)
+
+async def run_polling():
+    # getUpdates is refused while a webhook is set, e.g. after switching back from webhook mode
+    await bot.delete_webhook()
+    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
 
 if __name__ == "__main__":
-    asyncio.run(dp.start_polling(bot))
+    if WEBHOOK_URL:
+        run_webhook()
+    else:
+        asyncio.run(run_polling())
@@ -0,0 +1,37 @@
+# main.py reads its bot token and creates files at import, so tests import it from a scratch directory.
+import importlib
+import os
+import sys
+
+import pytest
+from cryptography.fernet import Fernet
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture(scope='module')
+def main(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('bot')
+    key = Fernet.generate_key()
+    (directory / 'encrypted_token.bin').write_bytes(Fernet(key).encrypt(b'123456:TEST'))
+    previous = os.getcwd()
+    os.chdir(directory)
+    environ = {
+        'ENCRYPTION_KEY': key.decode(),
+        'DB_PATH': str(directory / 'bot.db'),
+        'TRANSCODE_ENABLED': '0',
+        'WEBHOOK_URL': 'https://example.test'
+    }
+    saved = {name: os.environ.get(name) for name in environ}
+    os.environ.update(environ)
+    sys.path.insert(0, ROOT)
+    try:
+        yield importlib.import_module('main')
+    finally:
+        sys.path.remove(ROOT)
+        sys.modules.pop('main', None)
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        os.chdir(previous)
@@ -0,0 +1,37 @@
+# Database read pool: a connection only goes back once its executor thread has finished with it.
+import asyncio
+import os
+import threading
+
+def test_cancelled_read_keeps_connection_until_thread_finishes(main, tmp_path):
+    started = threading.Event()
+    proceed = threading.Event()
+
+    def blocking_fetch(connection, sql, params):
+        started.set()
+        proceed.wait(5)
+        return main.read_fetchone(connection, sql, params)
+
+    async def scenario():
+        db = main.Database(os.path.join(tmp_path, 'reads.db'), 2, 10)
+        await db.start()
+        try:
+            read = asyncio.create_task(db.read(blocking_fetch, "SELECT 1", ()))
+            while not started.is_set():
+                await asyncio.sleep(0.01)
+            read.cancel()
+            await asyncio.gather(read, return_exceptions=True)
+            # The thread still runs on the cancelled read's connection, so only the other one is free
+            held = db.read_pool.qsize()
+            assert await db.fetchval("SELECT 2") == 2
+            proceed.set()
+            while db.read_pool.qsize() < 2:
+                await asyncio.sleep(0.01)
+            return held, read.cancelled()
+        finally:
+            proceed.set()
+            await db.close()
+
+    held, cancelled = asyncio.run(scenario())
+    assert cancelled
+    assert held == 1
@@ -0,0 +1,49 @@
+# Checks which audio format ydl_download_fitting hands to yt-dlp, without touching the network.
+import pytest
+import yt_dlp
+
+MB = 1024 * 1024
+
+def fake_info(formats):
+    return {
+        'id': 'abc',
+        'title': 'Track',
+        'duration': 200,
+        'extractor': 'youtube',
+        'extractor_key': 'Youtube',
+        'webpage_url': 'https://www.youtube.com/watch?v=abc',
+        'formats': formats
+    }
+
+def audio_format(format_id, ext, abr, size):
+    return {
+        'format_id': format_id,
+        'url': f"https://example.test/{format_id}",
+        'ext': ext,
+        'vcodec': 'none',
+        'acodec': 'opus' if ext == 'webm' else 'mp4a.40.2',
+        'abr': abr,
+        'filesize': size
+    }
+
+@pytest.fixture
+def downloads(monkeypatch):
+    selected = []
+    info = fake_info([audio_format('251', 'webm', 160, 60 * MB), audio_format('140', 'm4a', 128, 3 * MB)])
+    monkeypatch.setattr(yt_dlp.YoutubeDL, 'extract_info', lambda self, url, download=True, process=True: info)
+    # process_info is where yt-dlp would start the download of the selected format
+    monkeypatch.setattr(yt_dlp.YoutubeDL, 'process_info', lambda self, info_dict: selected.append(info_dict['format_id']))
+    return selected
+
+def test_oversized_best_format_is_skipped(main, downloads):
+    main.ydl_download_fitting({'format': 'bestaudio', 'quiet': True}, 'https://www.youtube.com/watch?v=abc', 50 * MB)
+    assert downloads == ['140']
+
+def test_best_format_is_kept_when_it_fits(main, downloads):
+    main.ydl_download_fitting({'format': 'bestaudio', 'quiet': True}, 'https://www.youtube.com/watch?v=abc', 100 * MB)
+    assert downloads == ['251']
+
+def test_nothing_fits(main, downloads):
+    with pytest.raises(main.DownloadError):
+        main.ydl_download_fitting({'format': 'bestaudio', 'quiet': True}, 'https://www.youtube.com/watch?v=abc', 1 * MB)
+    assert downloads == []
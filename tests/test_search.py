@@ -0,0 +1,34 @@
+# process_search tells an overloaded search pool apart from an empty result.
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+USER_ID = 4242
+
+def search(main, monkeypatch, outcome):
+    async def cached_youtube_search(*args):
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    monkeypatch.setattr(main, 'cached_youtube_search', cached_youtube_search)
+    message = MagicMock(text='  кино  ', answer=AsyncMock())
+    state = MagicMock(clear=AsyncMock())
+    # UserMiddleware pins the counters for the duration of an update
+    main.counter_store.pin(USER_ID, 0, 0)
+    try:
+        asyncio.run(main.process_search(message, state, main.UserRecord(USER_ID)))
+    finally:
+        main.counter_store.unpin(USER_ID)
+        main.counter_store.pending.pop(USER_ID, None)
+    return [call.args[0] for call in message.answer.await_args_list], state.clear.await_count
+
+def test_busy_search_pool_is_not_reported_as_no_results(main, monkeypatch):
+    answers, cleared = search(main, monkeypatch, main.StageBusyError("Очередь 'search' переполнена"))
+    assert answers == ["⚠️ Сервис перегружен. Попробуйте через минуту."]
+    # Still in the search state, so sending the query again retries it
+    assert cleared == 0
+
+def test_failed_search_reports_no_results(main, monkeypatch):
+    answers, cleared = search(main, monkeypatch, RuntimeError("HTTP Error 429"))
+    assert answers == ["❌ Ничего не найдено по запросу."]
+    assert cleared == 1
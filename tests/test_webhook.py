@@ -0,0 +1,140 @@
+# Feeds updates through the webhook app in-process, against a fake Bot API server.
+import asyncio
+import time
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from aiogram.client.telegram import TelegramAPIServer
+
+USER_ID = 42
+
+@pytest.fixture(scope='module', autouse=True)
+def offline(main):
+    # Startup launches chart refreshes and the prefetcher; their yt-dlp calls get empty answers instead of YouTube
+    def extract_info(ydl_opts, url):
+        return {'entries': []}
+
+    def download_fitting(ydl_opts, url, max_bytes):
+        raise main.DownloadError("нет сети в тестах")
+
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(main, 'ydl_extract_info', extract_info)
+        patch.setattr(main, 'ydl_download_fitting', download_fitting)
+        yield
+
+@pytest.fixture(scope='module')
+def loop():
+    # main.py creates its queues and locks at import, so every test shares one event loop
+    loop = asyncio.new_event_loop()
+    yield loop
+    # Same teardown as asyncio.run and web.run_app: detached work such as chart refreshes is cancelled
+    pending = asyncio.all_tasks(loop)
+    for task in pending:
+        task.cancel()
+    if pending:
+        loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+    loop.close()
+
+def fake_bot_api(calls):
+    async def handle(request):
+        method = request.match_info['method']
+        calls.append(method)
+        if method == 'getChatMember':
+            result = {'status': 'member', 'user': {'id': USER_ID, 'is_bot': False, 'first_name': 'Test'}}
+        elif method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Bot', 'username': 'bot'}
+        elif method in ('setWebhook', 'deleteWebhook', 'deleteMessage'):
+            result = True
+        else:
+            result = {
+                'message_id': len(calls),
+                'date': int(time.time()),
+                'chat': {'id': USER_ID, 'type': 'private'},
+                'text': 'ok'
+            }
+        return web.json_response({'ok': True, 'result': result})
+
+    app = web.Application()
+    app.router.add_route('*', '/bot{token}/{method}', handle)
+    return app
+
+def start_update(update_id):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': USER_ID, 'type': 'private'},
+            'from': {'id': USER_ID, 'is_bot': False, 'first_name': 'Test'},
+            'text': '/start'
+        }
+    }
+
+async def with_webhook(main, scenario):
+    calls = []
+    api = TestServer(fake_bot_api(calls))
+    await api.start_server()
+    main.bot.session.api = TelegramAPIServer.from_base(str(api.make_url('')).rstrip('/'))
+    client = TestClient(TestServer(main.create_webhook_app()))
+    await client.start_server()
+    try:
+        return await scenario(client, calls)
+    finally:
+        await client.close()
+        await main.bot.session.close()
+        await api.close()
+
+async def wait_for_call(calls, method, timeout=5):
+    deadline = time.monotonic() + timeout
+    while method not in calls:
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.05)
+    return True
+
+def test_wrong_secret_is_rejected(main, loop):
+    async def scenario(client, calls):
+        response = await client.post(main.WEBHOOK_PATH, json=start_update(1),
+                                     headers={'X-Telegram-Bot-Api-Secret-Token': 'wrong'})
+        missing = await client.post(main.WEBHOOK_PATH, json=start_update(2))
+        await asyncio.sleep(0.2)
+        return response.status, missing.status, calls
+
+    status, missing, calls = loop.run_until_complete(with_webhook(main, scenario))
+    assert status == 401
+    assert missing == 401
+    assert 'sendMessage' not in calls
+
+def test_update_runs_handler(main, loop):
+    async def scenario(client, calls):
+        response = await client.post(main.WEBHOOK_PATH, json=start_update(3),
+                                     headers={'X-Telegram-Bot-Api-Secret-Token': main.WEBHOOK_SECRET})
+        handled = await wait_for_call(calls, 'sendMessage')
+        row = await main.db.fetchone("SELECT id FROM users WHERE id = ?", (USER_ID,))
+        return response.status, handled, row
+
+    status, handled, row = loop.run_until_complete(with_webhook(main, scenario))
+    assert status == 200
+    assert handled
+    assert row is not None
+
+def test_startup_and_shutdown_are_clean(main, loop):
+    def background_tasks():
+        return [
+            main.db.writer, main.loop_lag_task, main.bot_status_task, main.counter_flush_task, main.chart_task,
+            main.recommender_task, main.prefetcher_task, main.fsm_purge_task, main.broadcast_watch_task,
+            *main.upload_stage.tasks
+        ]
+
+    async def scenario(client, calls):
+        return [task.done() for task in background_tasks()]
+
+    async def lifecycle():
+        running = await with_webhook(main, scenario)
+        await asyncio.sleep(0.1)
+        return running, [task.done() for task in background_tasks()]
+
+    running, stopped = loop.run_until_complete(lifecycle())
+    assert not any(running)
+    assert all(stopped)